@@ -90,6 +90,27 @@ def serialFlush(ser: Serial, IO: bool) -> None:
         ser.reset_input_buffer()
     return None
 
+def writePipelined(ser: Serial, cmds: list[str], chunk_size: int = 32) -> None:
+    """
+    Writes commands in chunks and reads the acknowledgements of each chunk in bulk.
+    Args:
+        ser (serial.Serial): The serial connection object. (Nirone)
+        cmds (list[str]): Commands terminated with a carriage return.
+        chunk_size (int): Number of commands written per chunk.
+    Raises:
+        Exception: If the sensor acknowledges fewer commands than were sent.
+    """
+    for start in range(0, len(cmds), chunk_size):
+        chunk = cmds[start:start + chunk_size]
+        ser.write("".join(chunk).encode())
+        received = 0
+        while received < len(chunk):
+            data = ser.read(max(1, ser.in_waiting))
+            if not data:
+                raise Exception(f"Error: Missing acknowledgements {received}/{len(chunk)}")
+            received += data.count(b"\n")
+    return None
+
 def sensorMeasureWavelengths(ser: Serial, measurement_count: int, min_wl: float, max_wl: float):
     """
     Performs wavelength measurements.
@@ -103,24 +124,17 @@ def sensorMeasureWavelengths(ser: Serial, measurement_count: int, min_wl: float,
     Raises:
         ValueError: If the minimum wavelength is larger than the maximum wavelength.
     """
-    cmd = ""
     current_wl = min_wl
     if min_wl > max_wl:
         raise Exception("Error: MinWL is larger than MaxWL")
     gap = (max_wl - min_wl) / (measurement_count - 1)
-    # Sending commands from index 0 to measurement_count-1
-    for i in range(measurement_count):
-        # Command format: "W0,123.0"
-        cmd = "W{0},{1:.1f}\r".format(i, current_wl)
-        write_command(ser, cmd)
+    cmds = []
+    # Command format: "W0,123.0", the last index is pinned to max_wl
+    for i in range(measurement_count - 1):
+        cmds.append("W{0},{1:.1f}\r".format(i, current_wl))
         current_wl += gap
-        # Reading command response
-        ser.readline()
-
-    # Sending the final command # FIXME why -1?
-    cmd = "W{0},{1:.1f}\r".format(measurement_count - 1, max_wl)
-    write_command(ser, cmd)
-    ser.readline()
+    cmds.append("W{0},{1:.1f}\r".format(measurement_count - 1, max_wl))
+    writePipelined(ser, cmds)
     return
 
 def measureGet(ser, verbose: bool) -> list:
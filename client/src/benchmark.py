@@ -0,0 +1,105 @@
+"""
+Benchmarks for client code paths that can run without the sensor or the Raspberry Pi attached.
+
+The serial benchmarks use pyserial's `loop://` port as a mock sensor: every command
+written to it is echoed back, which stands in for the `\\r` terminated acknowledgement.
+
+Usage:
+    python3 benchmark.py            # run all benchmarks
+    python3 benchmark.py wavelengths
+    python3 benchmark.py upload
+    python3 benchmark.py envelope
+"""
+import os
+import sys
+import tempfile
+import time
+import timeit
+import numpy as np
+from serial_device import SerialDevice, SPECTRUM_POINTS
+from savgol import SavgolFilter, savgol_filter
+from bt.bt_auth import BTAuth, FORMAT_JSON, FORMAT_BINARY
+from spectrum_codec import encode_json, encode_spectrum, decode_spectrum, deflate
+
+def timed(fn) -> float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+def bench_wavelengths() -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        cache_path = os.path.join(tmp, "wavelength_cache.json")
+        device = SerialDevice(None, port="loop://", wl_cache_path=os.path.join(tmp, "unused.json"))
+        grid = device.wavelength_grid(SPECTRUM_POINTS, 1550.0, 1950.0)
+
+        def legacy():
+            # One byte per write and a blocking read per command, as startup used to do
+            for i, wl in enumerate(grid):
+                device.write_command("W{0},{1:.1f}\r".format(i, wl))
+                device.read_response()
+
+        print(f"wavelengths legacy:    {timed(legacy) * 1000:8.1f} ms")
+        print(f"wavelengths pipelined: {timed(lambda: SerialDevice(None, port='loop://', wl_cache_path=cache_path)) * 1000:8.1f} ms")
+        print(f"wavelengths cached:    {timed(lambda: SerialDevice(None, port='loop://', wl_cache_path=cache_path)) * 1000:8.1f} ms")
+    return None
+
+def bench_savgol() -> None:
+    spectrum = np.random.default_rng(0).random(SPECTRUM_POINTS).astype(np.float32)
+    smoothing = SavgolFilter(30, 3)
+    runs = 2000
+    per_call = timeit.timeit(lambda: smoothing.apply(spectrum), number=runs) / runs
+    print(f"savgol 30/3:           {per_call * 1e6:8.1f} us")
+    try:
+        from scipy.signal import savgol_filter as scipy_savgol_filter
+    except ImportError:
+        print("savgol: scipy not installed, skipping comparison")
+        return None
+    for window_length, polyorder, deriv in ((30, 3, 0), (31, 3, 0), (11, 2, 1), (30, 3, 2)):
+        expected = scipy_savgol_filter(spectrum.astype(np.float64), window_length, polyorder, deriv)
+        result = savgol_filter(spectrum.astype(np.float64), window_length, polyorder, deriv)
+        print(f"savgol {window_length}/{polyorder}/{deriv} max abs diff vs scipy: {np.abs(result - expected).max():.2e}")
+    return None
+
+def bench_upload() -> None:
+    # Raw intensities like the sensor returns them, the upload carries unscaled spectra
+    spectrum = (np.random.default_rng(0).random(SPECTRUM_POINTS) * 40000).astype(np.float32)
+    packet = {"data": spectrum, "time": 1700000000, "id": 1, "type": "m"}
+    runs = 2000
+    encoders = (
+        ("json (tolist)", lambda: encode_json(packet)),
+        ("float32", lambda: encode_spectrum(packet, "float32")),
+        ("float32+deflate", lambda: deflate(encode_spectrum(packet, "float32"))),
+        ("float16", lambda: encode_spectrum(packet, "float16")),
+        ("float16+deflate", lambda: deflate(encode_spectrum(packet, "float16"))),
+    )
+    for name, encode in encoders:
+        per_call = timeit.timeit(encode, number=runs) / runs
+        print(f"upload {name:16} {len(encode()):6d} B {per_call * 1e6:8.1f} us")
+    error = np.abs(decode_spectrum(encode_spectrum(packet, "float16"))["data"] - spectrum) / spectrum
+    print(f"upload float16 max relative error: {error.max():.1e}")
+    return None
+
+def bench_envelope() -> None:
+    bt_auth = BTAuth("HopeGatheringSubstitutionWestRow", "ModalTerritoryAlligatorCyanNorth")
+    # A poll_Label reply as BSDClient.decode_labels formats it
+    reply = "Cotton: 70.2%\nWool: 20.1%\nPolyester: 9.7%\n"
+    runs = 2000
+    for reply_format in (FORMAT_JSON, FORMAT_BINARY):
+        bt_auth.reply_format = reply_format
+        sealed = bt_auth.seal(reply)
+        seal_time = timeit.timeit(lambda: bt_auth.seal(reply), number=runs) / runs
+        open_time = timeit.timeit(lambda: bt_auth.decrypt_message(sealed), number=runs) / runs
+        print(f"envelope {reply_format:6} {len(sealed):4d} B, seal {seal_time * 1e6:6.1f} us, open {open_time * 1e6:6.1f} us")
+    return None
+
+BENCHMARKS = {
+    "wavelengths": bench_wavelengths,
+    "savgol": bench_savgol,
+    "upload": bench_upload,
+    "envelope": bench_envelope,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
@@ -0,0 +1,60 @@
+from typing import Optional
+from bt.bt_auth import BTAuth, FORMAT_SESSION
+from bt.bt_session import CHANNEL_REPLY
+
+# Longest plaintext whose encrypted JSON envelope still fits the 512 byte attribute value limit:
+# 130 bytes of envelope, the base64 of the AES-CBC ciphertext and at least one byte of padding.
+# The binary envelope fits far more, pages are sized for JSON as long as apps may use it
+MAX_REPLY_MESSAGE = 271
+
+class ReplyBoard():
+    """
+    Encrypted replies for the BLE Rx characteristic.
+
+    Replies are computed on the asyncio loop and read by `RxCharacteristic.ReadValue`
+    on the GLib thread. A reply is fully built as immutable bytes before it is published
+    with a single reference assignment, so a read during a measurement sees either the
+    previous reply or the new one, never a partial value.
+
+    Every reply is sealed with a fresh IV or session counter, equal replies never share
+    a ciphertext. `precompute()` seals the pending result into a single slot as soon as it
+    is known, the next `publish()` of that result uses it once instead of sealing it when
+    the phone polls. Session frames are sealed when published, each one takes the next
+    counter of its channel.
+    """
+
+    def __init__(self, bt_auth: BTAuth) -> None:
+        self.bt_auth = bt_auth
+        # (envelope format, plaintext, sealed reply) of the precomputed result
+        self.pending: Optional[tuple[str, str, bytes]] = None
+        self.current: bytes = b""
+
+    def prepare(self, message: str, channel: str = CHANNEL_REPLY) -> bytes:
+        if self.bt_auth.reply_format == FORMAT_SESSION:
+            return self.bt_auth.seal(message, channel)
+        return self.bt_auth.seal(message)
+
+    def precompute(self, message: str) -> None:
+        """Seals `message` for the next `publish()`, a session frame would only use up a counter and is sealed when published."""
+        if self.bt_auth.reply_format == FORMAT_SESSION:
+            self.pending = None
+            return None
+        try:
+            self.pending = (self.bt_auth.reply_format, message, self.prepare(message))
+        except Exception as e:
+            self.pending = None
+            print("Failed to prepare BLE reply: ", e)
+        return None
+
+    def publish(self, message: str) -> None:
+        pending = self.pending
+        try:
+            if pending is not None and pending[:2] == (self.bt_auth.reply_format, message):
+                # Used once, publishing the same result again seals it anew
+                self.pending = None
+                self.current = pending[2]
+            else:
+                self.current = self.prepare(message)
+        except Exception as e:
+            print("Failed to publish BLE reply: ", e)
+        return None
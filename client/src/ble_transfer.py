@@ -0,0 +1,277 @@
+import struct
+from collections import deque
+from typing import Callable, Optional
+
+# kind, transfer id, sequence number, chunk count
+CHUNK_HEADER = struct.Struct("<BBHH")
+# KIND_ACK, transfer id, next sequence number expected by the receiver
+ACK_FRAME = struct.Struct("<BBH")
+
+KIND_RESULT = 1
+KIND_HISTORY = 2
+KIND_SPECTRUM = 3
+# Per wavelength variance of a burst, same encoding as KIND_SPECTRUM
+KIND_VARIANCE = 4
+KIND_ACK = 0x80
+
+DEFAULT_MTU = 23
+# Opcode and attribute handle in front of every notification
+ATT_NOTIFY_OVERHEAD = 3
+MAX_CHUNKS = 0xFFFF
+
+class TransferError(Exception):
+    pass
+
+def chunk_size(mtu: int) -> int:
+    return max(1, mtu - ATT_NOTIFY_OVERHEAD - CHUNK_HEADER.size)
+
+def split_frames(kind: int, transfer_id: int, payload: bytes, mtu: int = DEFAULT_MTU) -> list[bytes]:
+    """Splits `payload` into notification sized frames, an empty payload is one empty frame."""
+    size = chunk_size(mtu)
+    count = max(1, -(-len(payload) // size))
+    if count > MAX_CHUNKS:
+        raise TransferError(f"Payload of {len(payload)} bytes needs more than {MAX_CHUNKS} chunks")
+    view = memoryview(payload)
+    return [
+        CHUNK_HEADER.pack(kind, transfer_id, seq, count) + view[seq * size:(seq + 1) * size]
+        for seq in range(count)
+    ]
+
+def ack_frame(transfer_id: int, next_seq: int) -> bytes:
+    return ACK_FRAME.pack(KIND_ACK, transfer_id, next_seq)
+
+class Reassembler():
+    """
+    Receiving side of the chunked transfer, as the app implements it.
+
+    Frames may arrive out of order or twice. `feed()` returns (kind, payload) once, when
+    the last missing chunk of a transfer comes in. `ack()` gives the cumulative
+    acknowledgement to write back, the first sequence number still missing. A frame of
+    an already complete transfer means the final acknowledgement was lost, ack again.
+    """
+
+    def __init__(self) -> None:
+        self.transfer_id: Optional[int] = None
+        self.kind = 0
+        self.count = 0
+        self.chunks: dict[int, bytes] = {}
+        self.complete = False
+
+    def feed(self, frame: bytes) -> Optional[tuple[int, bytes]]:
+        if len(frame) < CHUNK_HEADER.size:
+            raise TransferError("Frame shorter than its header")
+        kind, transfer_id, seq, count = CHUNK_HEADER.unpack_from(frame)
+        if transfer_id != self.transfer_id:
+            self.transfer_id, self.kind, self.count, self.chunks = transfer_id, kind, count, {}
+            self.complete = False
+        if seq < count:
+            self.chunks.setdefault(seq, bytes(frame[CHUNK_HEADER.size:]))
+        if self.complete or len(self.chunks) < self.count:
+            return None
+        self.complete = True
+        payload = b"".join(self.chunks[seq] for seq in range(self.count))
+        return self.kind, payload
+
+    def ack(self) -> bytes:
+        next_seq = 0
+        while next_seq in self.chunks:
+            next_seq += 1
+        return ack_frame(self.transfer_id or 0, next_seq)
+
+class Transfer():
+    __slots__ = ("transfer_id", "frames", "acked", "sent", "retries")
+
+    def __init__(self, transfer_id: int, frames: list[bytes]) -> None:
+        self.transfer_id = transfer_id
+        self.frames = frames
+        self.acked = 0
+        self.sent = 0
+        self.retries = 0
+
+class ChunkedNotifier():
+    """
+    Sends payloads of any size as a sequence of notifications with flow control.
+
+    Every payload is split into frames of (MTU - 3) bytes, a 6 byte header (kind,
+    transfer id, sequence number, chunk count) followed by a slice of the payload. At
+    most `window` frames are unacknowledged at a time. The receiver acknowledges with
+    the next sequence number it is missing, which releases the window. If nothing is
+    acknowledged for `ack_timeout` seconds the unacknowledged frames are sent again,
+    after `max_retries` timeouts in a row the transfer is dropped. Transfers are sent
+    one after another in the order they were pushed.
+
+    The notifier is driven from the thread that owns the BLE connection: `send`,
+    `call_soon` and `call_later` are provided by the caller, `push()` may be called
+    from any thread as long as `call_soon` is thread-safe (GLib.idle_add is).
+
+    Usage Example:
+    ```
+    notifier = ChunkedNotifier(send=notify, call_soon=GLib.idle_add, call_later=timeout_add)
+    notifier.push(KIND_RESULT, encrypted_reply)
+    notifier.on_ack(written_value)
+    ```
+    """
+
+    def __init__(self, send: Callable[[bytes], None], call_soon: Callable, call_later: Callable,
+                 window: int = 8, ack_timeout: float = 1.0, max_retries: int = 8, max_queued: int = 8) -> None:
+        self.send = send
+        self.call_soon = call_soon
+        self.call_later = call_later
+        self.window = window
+        self.ack_timeout = ack_timeout
+        self.max_retries = max_retries
+        self.mtu = DEFAULT_MTU
+        self.queue: deque = deque(maxlen=max_queued)
+        self.current: Optional[Transfer] = None
+        self.next_id = 0
+        # Bumped whenever the ack timer is re-armed, callbacks of older timers do nothing
+        self.timer_token = 0
+        self.completed = 0
+        self.failed = 0
+
+    def push(self, kind: int, payload: bytes) -> None:
+        self.call_soon(self._enqueue, kind, payload)
+        return None
+
+    def set_mtu(self, mtu: int) -> None:
+        # Takes effect from the next transfer, frames of the current one are already cut
+        if mtu >= DEFAULT_MTU:
+            self.mtu = mtu
+        return None
+
+    def reset(self) -> None:
+        """Drops the current and queued transfers, e.g. when the app unsubscribes."""
+        self.queue.clear()
+        self.current = None
+        self.timer_token += 1
+        return None
+
+    def on_ack(self, value: bytes) -> None:
+        if len(value) < ACK_FRAME.size:
+            return None
+        kind, transfer_id, next_seq = ACK_FRAME.unpack_from(value)
+        transfer = self.current
+        if kind != KIND_ACK or transfer is None or transfer_id != transfer.transfer_id:
+            return None
+        if next_seq > transfer.acked:
+            transfer.acked = min(next_seq, len(transfer.frames))
+            transfer.retries = 0
+            # Frames before the acknowledged one are never resent
+            transfer.sent = max(transfer.sent, transfer.acked)
+        if transfer.acked == len(transfer.frames):
+            self.completed += 1
+            self._start_next()
+        else:
+            self._pump()
+        return None
+
+    def _enqueue(self, kind: int, payload: bytes) -> bool:
+        try:
+            frames = split_frames(kind, self.next_id, payload, self.mtu)
+        except TransferError as e:
+            print("Dropping BLE transfer: ", e)
+            return False
+        self.queue.append(Transfer(self.next_id, frames))
+        self.next_id = (self.next_id + 1) & 0xFF
+        if self.current is None:
+            self._start_next()
+        # False removes a GLib idle source after its first run
+        return False
+
+    def _start_next(self) -> None:
+        self.current = self.queue.popleft() if self.queue else None
+        self.timer_token += 1
+        if self.current is not None:
+            self._pump()
+        return None
+
+    def _pump(self) -> None:
+        transfer = self.current
+        limit = min(len(transfer.frames), transfer.acked + self.window)
+        while transfer.sent < limit:
+            self.send(transfer.frames[transfer.sent])
+            transfer.sent += 1
+        self.timer_token += 1
+        token = self.timer_token
+        self.call_later(self.ack_timeout, lambda: self._on_timeout(token))
+        return None
+
+    def _on_timeout(self, token: int) -> None:
+        transfer = self.current
+        if token != self.timer_token or transfer is None:
+            return None
+        transfer.retries += 1
+        if transfer.retries > self.max_retries:
+            print(f"BLE transfer {transfer.transfer_id} not acknowledged, dropping it")
+            self.failed += 1
+            self._start_next()
+            return None
+        # Go back to the first unacknowledged frame
+        transfer.sent = transfer.acked
+        self._pump()
+        return None
+
+def main():
+    """
+    Test harness over a simulated lossy link, run from src with `python3 ble_transfer.py`.
+    The link loses 15 % of the notifications and 10 % of the acks, every payload must arrive intact and in order.
+    """
+    import heapq
+    import itertools
+    import random
+    rng = random.Random(1)
+    latency, notify_loss, ack_loss = 0.01, 0.15, 0.10
+    # Virtual clock, (due, order, callback) in place of the GLib main loop
+    events: list = []
+    order = itertools.count()
+    now = 0.0
+
+    def schedule(delay: float, callback: Callable) -> None:
+        heapq.heappush(events, (now + delay, next(order), callback))
+        return None
+
+    stats = {"sent": 0, "lost": 0, "acks": 0, "acks_lost": 0}
+    app = Reassembler()
+    received = []
+
+    def deliver(frame: bytes) -> None:
+        result = app.feed(frame)
+        if result is not None:
+            received.append(result)
+        # The app acknowledges every frame it gets, write without response
+        stats["acks"] += 1
+        if rng.random() < ack_loss:
+            stats["acks_lost"] += 1
+        else:
+            ack = app.ack()
+            schedule(latency, lambda: notifier.on_ack(ack))
+        return None
+
+    def send(frame: bytes) -> None:
+        stats["sent"] += 1
+        if rng.random() < notify_loss:
+            stats["lost"] += 1
+        else:
+            schedule(latency, lambda: deliver(frame))
+        return None
+
+    notifier = ChunkedNotifier(send=send, call_soon=lambda callback, *args: schedule(0.0, lambda: callback(*args)),
+                               call_later=schedule)
+    payloads = [(KIND_RESULT, b"Cotton: 70%\nWool: 20%\nPolyester: 10%\n"),
+                (KIND_HISTORY, rng.randbytes(5000)),
+                (KIND_SPECTRUM, rng.randbytes(2048)),
+                (KIND_VARIANCE, rng.randbytes(2048))]
+    for kind, payload in payloads:
+        notifier.push(kind, payload)
+    while events:
+        now, _, callback = heapq.heappop(events)
+        callback()
+    frames = sum(len(split_frames(kind, 0, payload)) for kind, payload in payloads)
+    print(f"{len(received)}/{len(payloads)} payloads in {now:.1f} s, {stats['sent']} notifications for {frames} frames, "
+          f"{stats['lost']} lost, {stats['acks_lost']}/{stats['acks']} acks lost, {notifier.failed} transfers dropped")
+    assert received == payloads, "payloads lost or corrupted"
+    assert notifier.completed == len(payloads) and notifier.failed == 0
+    return
+
+if __name__ == "__main__":
+    main()
@@ -1,43 +1,123 @@
 import os
-import socket
-import sys
-import json
+import asyncio
+from typing import Optional
+import numpy as np
+from inference.ipc_protocol import MSG_SPECTRUM, MSG_PREDICTION, MSG_ERROR, MSG_INFO, FrameError
+from inference.ipc_protocol import read_frame, write_frame, write_array, decode_array
 
 class BSDClient():
-    def __init__(self) -> None:
+    """
+    Client for the local inference server on the model IPC socket.
+
+    The connection is opened on first use, kept open between measurements and
+    re-established automatically if the server restarts. Replies are matched to
+    requests by request id, so concurrent callers can share the one connection.
+
+    `model_version` is asked from the server on every connect, it is None until then
+    or if the server does not report one.
+    """
+
+    def __init__(self, timeout: float = 5.0) -> None:
         self.LABELS = ["Polyester", "Cotton", "Wool"]
         self.SOCK_POST = '/tmp/model-ipc-post.socket'
         if not os.path.exists(self.SOCK_POST):
             print(f"WARNING: File {self.SOCK_POST} doesn't exist")
+        self.timeout = timeout
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.reader_task: Optional[asyncio.Task] = None
+        self.pending: dict[int, asyncio.Future] = {}
+        self.next_id = 0
+        self.connect_lock: Optional[asyncio.Lock] = None
+        self.model_version: Optional[str] = None
 
-        self.socket_post = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    async def connect(self) -> None:
+        # Created lazily so the lock belongs to the running loop
+        if self.connect_lock is None:
+            self.connect_lock = asyncio.Lock()
+        async with self.connect_lock:
+            if self.writer is not None and not self.writer.is_closing():
+                return None
+            print("connecting to socket")
+            reader, writer = await asyncio.open_unix_connection(self.SOCK_POST)
+            # Requests are tracked per connection, a reconnect starts with an empty table
+            self.writer = writer
+            self.pending = {}
+            self.reader_task = asyncio.get_running_loop().create_task(self.read_replies(reader, writer, self.pending))
+            try:
+                info = await self.request(writer, self.pending, lambda request_id: write_frame(writer, MSG_INFO, request_id, b""))
+                self.model_version = info.decode(errors='ignore')
+            except (RuntimeError, asyncio.TimeoutError) as e:
+                print("Inference server did not report a model version: ", e)
+                self.model_version = None
+        return None
 
-    def local_inference(self, data: list):
-        print("connecting to socket")
+    async def read_replies(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, pending: dict[int, asyncio.Future]) -> None:
+        error: Exception = ConnectionError("Inference server closed the connection")
         try:
-            print("SOCKET FILENO: ", self.socket_post.fileno())
-            self.socket_post.connect('/tmp/model-ipc-post.socket')
-        except Exception as e:
-            print("Socket already connected: ", e)
-            
-        decoded_labels = ""
-        serialized_data = json.dumps(data)
-        self.socket_post.sendall(serialized_data.encode())
-        print("Sending bytes: ", sys.getsizeof(serialized_data.encode()))
-        print("Wait for response")
-        result = self.socket_post.recv(1024).decode()
-        print(f'Received bytes: {repr(result)}')
+            while True:
+                msg_type, request_id, payload = await read_frame(reader)
+                future = pending.pop(request_id, None)
+                if future is None or future.done():
+                    continue
+                if msg_type == MSG_PREDICTION:
+                    future.set_result(decode_array(payload))
+                elif msg_type == MSG_INFO:
+                    future.set_result(payload)
+                elif msg_type == MSG_ERROR:
+                    future.set_exception(RuntimeError(payload.decode(errors='ignore')))
+                else:
+                    future.set_exception(FrameError(f"Unexpected message type {msg_type}"))
+        except (asyncio.IncompleteReadError, ConnectionError, FrameError) as e:
+            error = ConnectionError(f"Inference connection lost: {e}")
+        finally:
+            # Fail whatever is still waiting, the next request reconnects
+            writer.close()
+            if self.writer is writer:
+                self.writer = None
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            pending.clear()
+        return None
+
+    async def request(self, writer: asyncio.StreamWriter, pending: dict[int, asyncio.Future], send):
+        """Writes one request with `send(request_id)` and waits for the reply with that id."""
+        request_id = self.next_id
+        self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+        future = asyncio.get_running_loop().create_future()
+        pending[request_id] = future
         try:
-            parsed_data = json.loads(result)
-            print(type(parsed_data))
+            send(request_id)
+            await writer.drain()
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            pending.pop(request_id, None)
+
+    async def predict(self, data) -> np.ndarray:
+        """Sends one spectrum and returns the model output row as float32."""
+        await self.connect()
+        writer = self.writer
+        return await self.request(writer, self.pending, lambda request_id: write_array(writer, MSG_SPECTRUM, request_id, data))
+
+    async def predict_many(self, spectra) -> list[np.ndarray]:
+        """Sends all spectra without waiting in between, so the server can batch them."""
+        return list(await asyncio.gather(*(self.predict(spectrum) for spectrum in spectra)))
+
+    async def local_inference(self, data) -> str:
+        decoded_labels = ""
+        for attempt in range(2):
             try:
-                decoded_labels = self.decode_labels(parsed_data[0])
+                prediction = await self.predict(data)
+                decoded_labels = self.decode_labels(prediction.tolist())
+                break
+            except (ConnectionError, OSError) as e:
+                # One retry covers a server restart between measurements
+                print("Local inference connection failed: ", e)
             except Exception as e:
-                print("Failed to decode labels from prediction: ", e)
-        except Exception as e:
-            print("Failed to load json object: ", e)
+                print("Failed to run local inference: ", e)
+                break
         return decoded_labels
-    
+
     def decode_labels(self, predicted_data):
         # Convert probabilities to percentages and sort them in descending order
         percentages = [round(prob * 100, 1) for prob in predicted_data]  # Round to one decimal place
@@ -47,6 +127,6 @@ class BSDClient():
         formatted_string = ""
         for percentage, label in sorted_data:
             formatted_string += f"{label}: {percentage}%\n"
-            
+
         print("FORMATTED: \n", formatted_string)
-        return formatted_string
\ No newline at end of file
+        return formatted_string
@@ -4,16 +4,34 @@ import hashlib
 import hmac
 import binascii
 import json
+import struct
+from typing import Optional, Union
 from Crypto.Cipher import AES
+from bt.bt_session import BleSession, SessionError, SESSION_VERSION, CHANNEL_REPLY
+
+# Binary envelope: version, nonce, plaintext length, then ciphertext and truncated HMAC tag
+ENVELOPE = struct.Struct("<B12sH")
+ENVELOPE_VERSION = 0xB1
+TAG_SIZE = 16
+# Context string of the envelope key derivation, the app derives the same key
+ENVELOPE_KEY_INFO = b"nir-ble-envelope-v1"
+
+FORMAT_JSON = "json"
+FORMAT_BINARY = "binary"
+FORMAT_SESSION = "session"
+SESSION_HELLO = "session_Hello:"
+SESSION_ACK = "session_Ack:"
 
 class HmacAuth:
     def __init__(self, shared_sig_key) -> None:
         self.__shared_sig_key = str(shared_sig_key).encode()
+        # Keyed once, every signature starts from a copy of this state
+        self.__template = hmac.new(self.__shared_sig_key, digestmod=hashlib.sha256)
 
     def __gen_signature(self, message: bytes) -> str:
-        k = self.__shared_sig_key
-        h = hmac.new(k, message, hashlib.sha256).hexdigest()
-        return h
+        h = self.__template.copy()
+        h.update(message)
+        return h.hexdigest()
     
     def ask_for_signature(self, message: bytes) -> str:
         s = self.__gen_signature(message)
@@ -48,11 +66,118 @@ class AesEncryption:
         m = m.decode()
         return m
     
-class BTAuth:
+class BinaryEnvelope:
+    """
+    Compact binary alternative to the JSON envelope, encrypt-then-MAC over raw bytes.
+
+        uint8      ENVELOPE_VERSION (0xB1, never "{" so it can not be taken for JSON)
+        12 bytes   random nonce
+        uint16 LE  plaintext length
+        n bytes    AES-256-CTR ciphertext, the counter block is nonce + 32 bit counter from 0
+        16 bytes   HMAC-SHA256 over everything before it, truncated
+
+    The keys are derived once from the shared keys, HMAC-SHA256(shared key, ENVELOPE_KEY_INFO),
+    and the keyed HMAC state is reused for every message.
+    """
     def __init__(self, shared_sig_key, shared_encr_key) -> None:
+        self.__encr_key = hmac.new(str(shared_encr_key).encode(), ENVELOPE_KEY_INFO, hashlib.sha256).digest()
+        sig_key = hmac.new(str(shared_sig_key).encode(), ENVELOPE_KEY_INFO, hashlib.sha256).digest()
+        self.__mac = hmac.new(sig_key, digestmod=hashlib.sha256)
+
+    def __tag(self, data: bytes) -> bytes:
+        h = self.__mac.copy()
+        h.update(data)
+        return h.digest()[:TAG_SIZE]
+
+    def seal(self, message: bytes) -> bytes:
+        nonce = os.urandom(12)
+        # A CTR cipher object is bound to its nonce, the derived key is what is reused
+        cipher = AES.new(self.__encr_key, AES.MODE_CTR, nonce=nonce)
+        sealed = ENVELOPE.pack(ENVELOPE_VERSION, nonce, len(message)) + cipher.encrypt(message)
+        return sealed + self.__tag(sealed)
+
+    def open(self, envelope: bytes) -> bytes:
+        """Raises ValueError if the envelope is malformed or does not authenticate."""
+        if len(envelope) < ENVELOPE.size + TAG_SIZE:
+            raise ValueError("Envelope too short")
+        version, nonce, length = ENVELOPE.unpack_from(envelope)
+        if version != ENVELOPE_VERSION or len(envelope) != ENVELOPE.size + length + TAG_SIZE:
+            raise ValueError("Malformed envelope")
+        if not hmac.compare_digest(self.__tag(envelope[:-TAG_SIZE]), envelope[-TAG_SIZE:]):
+            raise ValueError("Envelope tag mismatch")
+        cipher = AES.new(self.__encr_key, AES.MODE_CTR, nonce=nonce)
+        return cipher.decrypt(envelope[ENVELOPE.size:-TAG_SIZE])
+
+class BTAuth:
+    """
+    Signs and encrypts the BLE messages, in the JSON envelope or the binary one.
+
+    Incoming messages are recognised by their first byte, and replies are sealed in the
+    format the app used last, so an app switches to the binary envelope simply by
+    sending in it. Until then everything stays JSON.
+
+    After a `session_Hello` handshake (see `bt_session.BleSession`) the app can send
+    session frames, which are checked against replay. With `require_session` only the
+    handshake itself is accepted in the other envelopes.
+
+    The long-term envelopes have no replay protection, so a hello may be a captured one.
+    The new session stays pending and the current one keeps working until the app
+    confirms the new keys with a session frame that authenticates under them.
+    """
+    def __init__(self, shared_sig_key, shared_encr_key, require_session: bool = False) -> None:
         # Compose the classes
+        self.__shared_sig_key = shared_sig_key
         self.auth_hmac = HmacAuth(shared_sig_key)
         self.auth_encr = AesEncryption(shared_encr_key)
+        self.envelope = BinaryEnvelope(shared_sig_key, shared_encr_key)
+        self.reply_format = FORMAT_JSON
+        self.require_session = require_session
+        self.session: Optional[BleSession] = None
+        # Handshake answered but not yet confirmed by a session frame of the app
+        self.pending_session: Optional[BleSession] = None
+
+    def start_session(self, client_nonce_hex: str) -> str:
+        """Starts a pending session for the app's nonce and returns the `session_Ack` reply, the current session is kept until the app uses the new one."""
+        try:
+            client_nonce = bytes.fromhex(client_nonce_hex)
+            server_nonce = BleSession.nonce()
+            self.pending_session = BleSession(self.__shared_sig_key, client_nonce, server_nonce)
+        except (ValueError, SessionError) as e:
+            print("Rejected session handshake: ", e)
+            return ""
+        return SESSION_ACK + server_nonce.hex()
+
+    def open_session_frame(self, frame: bytes) -> str:
+        session, pending = self.session, self.pending_session
+        if session is None and pending is None:
+            print("Warning: Session frame without a session handshake")
+            return ""
+        error = None
+        for candidate in (session, pending):
+            if candidate is None:
+                continue
+            try:
+                decrypted_message = candidate.open(frame).decode()
+            except (SessionError, UnicodeDecodeError) as e:
+                # The current session's reason is the one worth reporting, e.g. a replay
+                error = error or e
+                continue
+            if candidate is pending:
+                # The app derived the keys of the new session, the previous one ends here
+                self.session = pending
+                self.pending_session = None
+            self.reply_format = FORMAT_SESSION
+            return decrypted_message
+        print("Warning: Dropping session frame: ", error)
+        return ""
+
+    def seal(self, message: str, channel: str = CHANNEL_REPLY) -> bytes:
+        """Encrypts a reply in the format the app last sent in, `channel` selects the session counter."""
+        if self.reply_format == FORMAT_SESSION and self.session is not None:
+            return self.session.seal(message.encode(), channel)
+        if self.reply_format == FORMAT_BINARY:
+            return self.envelope.seal(message.encode())
+        return self.encrypt_message(message).encode()
 
     def encrypt_message(self, message: str) -> str:
         print("ENCRYPT")
@@ -65,7 +190,19 @@ class BTAuth:
         result = json.dumps({"signature": signature, "message": encrypted_message, "iv": iv})
         return result
     
-    def decrypt_message(self, signed_message: str) -> str:
+    def decrypt_message(self, signed_message: Union[str, bytes]) -> str:
+        if isinstance(signed_message, (bytes, bytearray)):
+            if signed_message[:1] == bytes([SESSION_VERSION]):
+                return self.open_session_frame(bytes(signed_message))
+            if signed_message[:1] == bytes([ENVELOPE_VERSION]):
+                try:
+                    decrypted_message = self.envelope.open(bytes(signed_message)).decode()
+                except ValueError:
+                    print("Warning: Binary envelope did not authenticate. Message has been modified mid-traffic!")
+                    return ""
+                self.reply_format = FORMAT_BINARY
+                return self.check_session_required(decrypted_message)
+            signed_message = signed_message.decode(errors='ignore')
         decrypted_message = ""
         # JSON String Deserialization to Dict object
         message_dict = json.loads(signed_message)
@@ -84,6 +221,7 @@ class BTAuth:
                     encrypted_message_bytes, 
                     iv_bytes
                     )
+                self.reply_format = FORMAT_JSON
             else:
                 print("Warning: Signature did not match. Message has been modified mid-traffic!")
                 print("Generated: ", gen_sign)
@@ -91,7 +229,14 @@ class BTAuth:
         except:
             decrypted_message = ""
             
-        return decrypted_message
+        return self.check_session_required(decrypted_message)
+
+    def check_session_required(self, message: str) -> str:
+        # The long-term envelopes carry no counter, with sessions required they may only open one
+        if self.require_session and message and not message.startswith(SESSION_HELLO):
+            print("Warning: Dropping message outside of a session")
+            return ""
+        return message
 
 def main():
     # Define the shared keys (example 256 Bits)
@@ -0,0 +1,191 @@
+import os
+import hmac
+import hashlib
+import struct
+from typing import Optional
+from Crypto.Cipher import AES
+
+# Session frame: version and message counter, then ciphertext and truncated HMAC tag
+SESSION_HEADER = struct.Struct("<BI")
+SESSION_VERSION = 0xB2
+SESSION_TAG_SIZE = 16
+NONCE_SIZE = 16
+MAX_COUNTER = 0xFFFFFFFF
+# Context string of the session key derivation, the app derives the same keys
+SESSION_KEY_INFO = b"nir-ble-session-v1"
+
+ROLE_DEVICE = "device"
+ROLE_APP = "app"
+
+# Writes of the app to the Rx characteristic
+CHANNEL_COMMAND = "command"
+# Replies the app reads from the Rx characteristic
+CHANNEL_REPLY = "reply"
+# Chunked Tx notifications, they arrive independently of the replies
+CHANNEL_NOTIFY = "notify"
+# Key derivation label of each channel
+CHANNEL_LABELS = {
+    CHANNEL_COMMAND: b"app",
+    CHANNEL_REPLY: b"device",
+    CHANNEL_NOTIFY: b"device notify",
+}
+
+class SessionError(Exception):
+    pass
+
+class BleSession:
+    """
+    Keys and message counters of one BLE session.
+
+    The app opens a session by sending `session_Hello:<client nonce>` in the JSON or
+    binary envelope, the device answers `session_Ack:<server nonce>` in the same way
+    (nonces are 16 random bytes as hex). Both sides then derive
+
+        secret = HMAC-SHA256(shared signature key, SESSION_KEY_INFO + client nonce + server nonce)
+
+    and from it an encryption and a MAC key per channel, HMAC-SHA256(secret, label)
+    with the labels b"app enc" / b"app mac" for commands, b"device enc" / b"device mac"
+    for read replies and b"device notify enc" / b"device notify mac" for Tx
+    notifications. Keys and keyed HMAC states are set up once per session.
+
+    Every channel has its own counter. Replies and notifications travel separately and
+    a notification may complete after a later reply was read, with one shared counter
+    the app would take it for a replay.
+
+    Session frames carry only a 5 byte header:
+
+        uint8      SESSION_VERSION (0xB2)
+        uint32 LE  message counter, starts at 1 and increases by one per message
+        n bytes    AES-256-CTR ciphertext, the nonce is 8 zero bytes + the counter (big endian)
+        16 bytes   HMAC-SHA256 over everything before it, truncated
+
+    A frame is only accepted if its counter is above the last one accepted on its
+    channel, so a captured frame can not be replayed within the session, and frames of
+    an older session or another channel do not authenticate.
+    """
+    def __init__(self, shared_sig_key, client_nonce: bytes, server_nonce: bytes, role: str = ROLE_DEVICE) -> None:
+        if len(client_nonce) != NONCE_SIZE or len(server_nonce) != NONCE_SIZE:
+            raise SessionError("Session nonces must be 16 bytes")
+        master = hmac.new(str(shared_sig_key).encode(), SESSION_KEY_INFO, hashlib.sha256).digest()
+        secret = hmac.new(master, SESSION_KEY_INFO + client_nonce + server_nonce, hashlib.sha256).digest()
+        keys = {label + kind: hmac.new(secret, label + kind, hashlib.sha256).digest()
+                for label in CHANNEL_LABELS.values() for kind in (b" enc", b" mac")}
+        if role == ROLE_DEVICE:
+            send, receive = (CHANNEL_REPLY, CHANNEL_NOTIFY), (CHANNEL_COMMAND,)
+        else:
+            send, receive = (CHANNEL_COMMAND,), (CHANNEL_REPLY, CHANNEL_NOTIFY)
+        self.__keys = {
+            channel: (keys[CHANNEL_LABELS[channel] + b" enc"],
+                      hmac.new(keys[CHANNEL_LABELS[channel] + b" mac"], digestmod=hashlib.sha256))
+            for channel in send + receive
+        }
+        self.default_send = send[0]
+        self.default_receive = receive[0]
+        self.server_nonce = server_nonce
+        self.send_counters = {channel: 0 for channel in send}
+        self.receive_counters = {channel: 0 for channel in receive}
+        self.rejected = 0
+
+    @staticmethod
+    def nonce() -> bytes:
+        return os.urandom(NONCE_SIZE)
+
+    @staticmethod
+    def __tag(mac, data: bytes) -> bytes:
+        h = mac.copy()
+        h.update(data)
+        return h.digest()[:SESSION_TAG_SIZE]
+
+    @staticmethod
+    def __counter_nonce(counter: int) -> bytes:
+        return bytes(8) + counter.to_bytes(4, "big")
+
+    def seal(self, message: bytes, channel: Optional[str] = None) -> bytes:
+        """Seals `message` for `channel`, by default replies on the device and commands on the app."""
+        channel = channel or self.default_send
+        if channel not in self.send_counters:
+            raise SessionError(f"Can not send on the {channel} channel")
+        counter = self.send_counters[channel]
+        if counter == MAX_COUNTER:
+            raise SessionError("Session counter exhausted, a new handshake is needed")
+        counter += 1
+        self.send_counters[channel] = counter
+        key, mac = self.__keys[channel]
+        cipher = AES.new(key, AES.MODE_CTR, nonce=self.__counter_nonce(counter))
+        sealed = SESSION_HEADER.pack(SESSION_VERSION, counter) + cipher.encrypt(message)
+        return sealed + self.__tag(mac, sealed)
+
+    def open(self, frame: bytes, channel: Optional[str] = None) -> bytes:
+        """Raises SessionError if the frame is malformed, does not authenticate or was seen before on `channel`."""
+        channel = channel or self.default_receive
+        if channel not in self.receive_counters:
+            raise SessionError(f"Can not receive on the {channel} channel")
+        if len(frame) < SESSION_HEADER.size + SESSION_TAG_SIZE:
+            raise SessionError("Session frame too short")
+        version, counter = SESSION_HEADER.unpack_from(frame)
+        if version != SESSION_VERSION:
+            raise SessionError("Not a session frame")
+        key, mac = self.__keys[channel]
+        # The tag is checked first, so a forged counter can not move the replay window
+        if not hmac.compare_digest(self.__tag(mac, frame[:-SESSION_TAG_SIZE]), frame[-SESSION_TAG_SIZE:]):
+            self.rejected += 1
+            raise SessionError("Session frame tag mismatch")
+        last = self.receive_counters[channel]
+        if counter <= last:
+            self.rejected += 1
+            raise SessionError(f"Replayed session frame, counter {counter} <= {last}")
+        self.receive_counters[channel] = counter
+        cipher = AES.new(key, AES.MODE_CTR, nonce=self.__counter_nonce(counter))
+        return cipher.decrypt(frame[SESSION_HEADER.size:-SESSION_TAG_SIZE])
+
+def main():
+    """
+    Test harness: a stand-in for the phone talks to the device side of BTAuth.
+    Run from src with `python3 -m bt.bt_session`.
+    """
+    from bt.bt_auth import BTAuth, FORMAT_BINARY
+    from ble_bridge import ReplyBoard
+    # Define the shared keys (example 256 Bits)
+    # NOTE: Do not keep keys in code, always adhere to best practices.
+    shared_sig_key = "HopeGatheringSubstitutionWestRow"
+    shared_encr_key = "ModalTerritoryAlligatorCyanNorth"
+    device = BTAuth(shared_sig_key, shared_encr_key)
+    phone = BTAuth(shared_sig_key, shared_encr_key)
+    phone.reply_format = FORMAT_BINARY
+
+    # Handshake in the long-term binary envelope
+    client_nonce = BleSession.nonce()
+    hello = device.decrypt_message(phone.seal("session_Hello:" + client_nonce.hex()))
+    ack = device.seal(device.start_session(hello.partition(":")[2]))
+    server_nonce = bytes.fromhex(phone.decrypt_message(ack).partition(":")[2])
+    phone_session = BleSession(shared_sig_key, client_nonce, server_nonce, role=ROLE_APP)
+
+    # Commands in session frames
+    captured = phone_session.seal(b"m_Whiteref")
+    print("Command: ", device.decrypt_message(captured))
+    print("Command: ", device.decrypt_message(phone_session.seal(b"poll_Label")))
+    replies = ReplyBoard(device)
+    result = "Cotton: 70%\nWool: 20%\nPolyester: 10%\n"
+    # The pushed result completes on the app only after the next poll was read
+    pushed = replies.prepare(result, CHANNEL_NOTIFY)
+    replies.publish(result)
+    print(f"Reply ({len(replies.current)} bytes): ", phone_session.open(replies.current, CHANNEL_REPLY).decode())
+    print("Late push: ", phone_session.open(pushed, CHANNEL_NOTIFY).decode().splitlines()[0])
+    try:
+        phone_session.open(pushed, CHANNEL_REPLY)
+    except SessionError as e:
+        print("Push read as a reply: ", e)
+
+    # Replayed and modified frames are dropped
+    print("Replayed: ", repr(device.decrypt_message(captured)))
+    # A replayed hello leaves the session in use, only frames under the new keys would end it
+    device.start_session(device.decrypt_message(phone.seal("session_Hello:" + client_nonce.hex())).partition(":")[2])
+    print("Command after a replayed hello: ", device.decrypt_message(phone_session.seal(b"poll_Label")))
+    tampered = bytearray(phone_session.seal(b"m_Darkref"))
+    tampered[6] ^= 1
+    print("Tampered: ", repr(device.decrypt_message(bytes(tampered))))
+    print("Next command: ", device.decrypt_message(phone_session.seal(b"m_Darkref")))
+    return
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,7 @@ from bt.bt_adv import register_ad_cb, register_ad_error_cb
 from bt.bt_gatt import Service, Characteristic
 from bt.bt_gatt import register_service_cb, register_service_error_cb
 from event_manager import EventManager
+from ble_transfer import ChunkedNotifier
 
 BLUEZ_SERVICE_NAME =           'org.bluez'
 DBUS_OM_IFACE =                'org.freedesktop.DBus.ObjectManager'
@@ -22,11 +23,18 @@ LOCAL_NAME =                   'rpi-gatt-server'
 mainloop = None
 
 class TxCharacteristic(Characteristic):
-    def __init__(self, bus, index, service):
-        # Only support for notify actions, no r / w
+    """
+    Pushes results, history and spectra to the app as chunked notifications.
+
+    Payloads are framed by `ble_transfer.ChunkedNotifier`, the app writes its
+    acknowledgements back to this characteristic (write without response).
+    """
+    def __init__(self, bus, index, service, event_manager: EventManager):
         Characteristic.__init__(self, bus, index, UART_TX_CHARACTERISTIC_UUID,
-                                ['notify'], service)
+                                ['notify', 'write-without-response'], service)
         self.notifying = False
+        self.notifier = ChunkedNotifier(send=self.notify_value, call_soon=GLib.idle_add, call_later=self.call_later)
+        event_manager.ble_tx = self
         # Watch for device console input
         GLib.io_add_watch(sys.stdin, GLib.IO_IN, self.on_console_input)
 
@@ -41,11 +49,26 @@ class TxCharacteristic(Characteristic):
     def send_tx(self, s):
         if not self.notifying:
             return
-        value = []
-        # Write value into the 
-        for c in s:
-            value.append(dbus.Byte(c.encode()))
-        self.PropertiesChanged(GATT_CHRC_IFACE, {'Value': value}, [])
+        self.notify_value(s.encode())
+
+    def notify_value(self, value: bytes):
+        self.PropertiesChanged(GATT_CHRC_IFACE, {'Value': dbus.ByteArray(value)}, [])
+
+    def call_later(self, delay: float, callback):
+        def run_once():
+            callback()
+            return False
+        GLib.timeout_add(int(delay * 1000), run_once)
+
+    def push(self, kind: int, payload: bytes):
+        # Called from the asyncio thread, the notifier hands the work to the GLib loop
+        if self.notifying:
+            self.notifier.push(kind, payload)
+
+    def WriteValue(self, value, options):
+        if 'mtu' in options:
+            self.notifier.set_mtu(int(options['mtu']))
+        self.notifier.on_ack(bytes(value))
 
     def StartNotify(self):
         if self.notifying:
@@ -56,6 +79,7 @@ class TxCharacteristic(Characteristic):
         if not self.notifying:
             return
         self.notifying = False
+        self.notifier.reset()
 
 class RxCharacteristic(Characteristic):
     def __init__(self, bus, index, service, event_manager: EventManager):
@@ -66,21 +90,25 @@ class RxCharacteristic(Characteristic):
     # Write to Server Characteristic interface with mobile app
     # This function Reads Value (message) that client sent
     def WriteValue(self, value, options):
-        data_string = ''.join([chr(b) for b in value])
-        print(f"UART RX: {data_string}")
-        self.event_manager.messager(data_string)
+        message = bytes(value)
+        print(f"UART RX: {message}")
+        if 'mtu' in options and self.event_manager.ble_tx is not None:
+            self.event_manager.ble_tx.notifier.set_mtu(int(options['mtu']))
+        self.event_manager.messager(message)
         
     # Read Characteristics button Interface with mobile app
     # This Sends to Client
     def ReadValue(self, options):
-        print("Client reading characteristic: ", self.event_manager.uart_rx_reader_field)
-        return self.event_manager.uart_rx_reader_field
+        # Replies are published as immutable bytes by the event loop, one reference read is enough
+        reply = self.event_manager.replies.current
+        print("Client reading characteristic: ", reply)
+        return reply
     
     
 class UartService(Service):
     def __init__(self, bus, index, event_manager):
         Service.__init__(self, bus, index, UART_SERVICE_UUID, True)
-        self.add_characteristic(TxCharacteristic(bus, 0, self))
+        self.add_characteristic(TxCharacteristic(bus, 0, self, event_manager))
         self.add_characteristic(RxCharacteristic(bus, 1, self, event_manager))
 
 class Application(dbus.service.Object):
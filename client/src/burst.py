@@ -0,0 +1,123 @@
+from dataclasses import dataclass
+from typing import Optional
+import numpy as np
+
+MODE_MEAN = "mean"
+MODE_MEDIAN = "median"
+
+@dataclass
+class BurstResult:
+    # Mean or median of the accepted scans
+    spectrum: np.ndarray
+    # Per wavelength sample variance of the accepted scans, zero for a single scan
+    variance: np.ndarray
+    accepted: int
+    rejected: int
+
+class BurstAccumulator():
+    """
+    Streaming average of the scans of one burst, with outlier rejection.
+
+    Every scan updates a running mean and sum of squared deviations per wavelength
+    (Welford), so the burst never holds more than the two float64 accumulators, except
+    in median mode where the accepted scans are also kept for the final median.
+
+    Once `min_scans` scans were accepted, a scan is compared to the running mean before
+    it is added: its RMS deviation from the mean, divided by the RMS of the standard
+    deviation so far (pooled over the wavelengths, which keeps it stable after only a
+    few scans). A scan in line with the others scores about 1, a scan that moved, was
+    shadowed or caught a lamp flicker scores far higher and is rejected above
+    `outlier_threshold`. The first `min_scans` scans can not be checked.
+
+    Usage Example:
+    ```
+    burst = BurstAccumulator(512, capacity=8)
+    for _ in range(8):
+        burst.add(await transport.read_floats(cmd, 512))
+    result = burst.result()
+    ```
+    """
+
+    def __init__(self, points: int, capacity: int, mode: str = MODE_MEAN,
+                 outlier_threshold: float = 4.0, min_scans: int = 3) -> None:
+        if mode not in (MODE_MEAN, MODE_MEDIAN):
+            raise ValueError(f"Unknown burst mode {mode!r}")
+        self.points = points
+        self.capacity = capacity
+        self.mode = mode
+        self.outlier_threshold = outlier_threshold
+        self.min_scans = min_scans
+        self.mean = np.zeros(points, dtype=np.float64)
+        self.m2 = np.zeros(points, dtype=np.float64)
+        self.delta = np.empty(points, dtype=np.float64)
+        self.scans = np.empty((capacity, points), dtype=np.float32) if mode == MODE_MEDIAN else None
+        self.accepted = 0
+        self.rejected = 0
+
+    def score(self, scan: np.ndarray) -> float:
+        """RMS deviation of `scan` from the running mean, in pooled standard deviations."""
+        np.subtract(scan, self.mean, out=self.delta)
+        pooled = np.sqrt(self.m2.mean() / (self.accepted - 1)) if self.accepted > 1 else 0.0
+        if pooled == 0.0:
+            return 0.0
+        return float(np.sqrt(np.dot(self.delta, self.delta) / self.points) / pooled)
+
+    def add(self, scan: np.ndarray) -> bool:
+        """Adds one scan, returns False if it was rejected as an outlier or the burst is full."""
+        if scan.shape != (self.points,) or self.accepted == self.capacity:
+            self.rejected += 1
+            return False
+        if self.accepted >= self.min_scans and self.score(scan) > self.outlier_threshold:
+            self.rejected += 1
+            return False
+        if self.scans is not None:
+            self.scans[self.accepted] = scan
+        self.accepted += 1
+        np.subtract(scan, self.mean, out=self.delta)
+        self.mean += self.delta / self.accepted
+        # m2 += delta * (scan - new mean)
+        self.delta *= scan - self.mean
+        self.m2 += self.delta
+        return True
+
+    def result(self) -> Optional[BurstResult]:
+        """The averaged spectrum and variance, None if no scan was accepted."""
+        if self.accepted == 0:
+            return None
+        if self.scans is not None:
+            spectrum = np.median(self.scans[:self.accepted], axis=0).astype(np.float32)
+        else:
+            spectrum = self.mean.astype(np.float32)
+        if self.accepted > 1:
+            variance = (self.m2 / (self.accepted - 1)).astype(np.float32)
+        else:
+            variance = np.zeros(self.points, dtype=np.float32)
+        return BurstResult(spectrum, variance, self.accepted, self.rejected)
+
+def main():
+    """
+    Test harness with synthetic scans, run from src with `python3 burst.py`.
+    Compares the noise of single scans and bursts and checks the outlier rejection.
+    """
+    rng = np.random.default_rng(1)
+    points, scans, sigma = 512, 8, 0.01
+    truth = 0.5 + 0.3 * np.sin(np.linspace(0, 6, points))
+    for mode in (MODE_MEAN, MODE_MEDIAN):
+        errors, rejected = [], 0
+        for _ in range(200):
+            burst = BurstAccumulator(points, scans, mode)
+            for i in range(scans):
+                scan = truth + rng.normal(0, sigma, points)
+                if i == 5:
+                    # Shadowed scan, 10 % less signal
+                    scan *= 0.9
+                burst.add(scan.astype(np.float32))
+            result = burst.result()
+            rejected += result.rejected
+            errors.append(np.sqrt(np.mean((result.spectrum - truth) ** 2)))
+        print(f"{mode}: RMS error {np.mean(errors):.5f} vs {sigma} for one scan, "
+              f"{rejected}/200 shadowed scans rejected, variance {result.variance.mean():.2e} vs {sigma ** 2:.0e}")
+    return
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+GESTURE_PRESS = "press"
+GESTURE_LONG = "long"
+GESTURE_CHORD = "chord"
+
+@dataclass(frozen=True)
+class ButtonGesture:
+    kind: str
+    buttons: frozenset
+    # time.monotonic() of the first press edge, the origin of what the gesture triggers
+    origin: float
+    # time.monotonic() of the edge that completed the gesture, used for the delivery latency
+    edge: float
+
+class GestureDetector():
+    """
+    Turns the press and release edges of a set of buttons into gestures.
+
+    An edge is ignored if it comes within `debounce` seconds of the last accepted edge
+    of the same button, or if it does not change the button's state. Contacts bounce
+    for a few milliseconds, so only the first edge of a bounce burst counts.
+
+    A gesture starts with the first press and ends when all buttons are up again:
+
+    - one button pressed and released: GESTURE_PRESS
+    - several buttons held at the same time: GESTURE_CHORD of all of them
+    - one button held for `long_press` seconds: GESTURE_LONG, reported by `held()` while
+      the button is still down, the release then ends the gesture without another one
+
+    The detector only keeps state and does no timing of its own, the edges and hold
+    notifications come from the GPIO library. All methods may be called from any thread.
+    """
+
+    def __init__(self, debounce: float = 0.03, long_press: float = 1.5) -> None:
+        self.debounce = debounce
+        self.long_press = long_press
+        self.lock = threading.Lock()
+        self.down: set = set()
+        self.gesture: set = set()
+        self.last_edge: dict[str, float] = {}
+        self.origin = 0.0
+        self.consumed = False
+        self.bounced = 0
+
+    def edge(self, name: str, pressed: bool, timestamp: Optional[float] = None) -> Optional[ButtonGesture]:
+        """Feeds one edge, returns the gesture it completes, if any."""
+        now = time.monotonic() if timestamp is None else timestamp
+        with self.lock:
+            if now - self.last_edge.get(name, float("-inf")) < self.debounce:
+                self.bounced += 1
+                return None
+            if pressed == (name in self.down):
+                return None
+            self.last_edge[name] = now
+            if pressed:
+                if not self.down:
+                    self.gesture.clear()
+                    self.origin = now
+                    self.consumed = False
+                self.down.add(name)
+                self.gesture.add(name)
+                return None
+            self.down.discard(name)
+            if self.down or self.consumed:
+                return None
+            kind = GESTURE_CHORD if len(self.gesture) > 1 else GESTURE_PRESS
+            return ButtonGesture(kind, frozenset(self.gesture), self.origin, now)
+
+    def held(self, name: str, timestamp: Optional[float] = None) -> Optional[ButtonGesture]:
+        """Called once `name` was held for `long_press` seconds, returns the long press if it is one."""
+        now = time.monotonic() if timestamp is None else timestamp
+        with self.lock:
+            # Part of a chord, or released and pressed again since the hold started
+            if self.consumed or self.gesture != {name} or name not in self.down:
+                return None
+            if now - self.last_edge[name] < self.long_press - self.debounce:
+                return None
+            self.consumed = True
+            return ButtonGesture(GESTURE_LONG, frozenset(self.gesture), self.origin, now)
+
+class ButtonInput():
+    """
+    Registers the edge callbacks of gpiozero buttons once and delivers their gestures
+    into an asyncio loop.
+
+    gpiozero calls `when_pressed`, `when_released` and `when_held` from its own threads.
+    The callbacks only feed the GestureDetector and never block, a completed gesture is
+    handed to the loop with call_soon_threadsafe and `handler` runs on the loop thread.
+    The buttons need `hold_time` set to the detector's `long_press`.
+
+    The time from the completing edge to the handler is kept, see `latency_ms()`.
+
+    Usage Example:
+    ```
+    buttons = {"measure": Button(17, pull_up=True, hold_time=1.5)}
+    button_input = ButtonInput(buttons, handler)
+    button_input.start(asyncio.get_running_loop())
+    ```
+    """
+
+    def __init__(self, buttons: dict, handler: Callable[[ButtonGesture], None],
+                 detector: Optional[GestureDetector] = None, latency_samples: int = 20) -> None:
+        self.buttons = buttons
+        self.handler = handler
+        self.detector = detector or GestureDetector()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.latency: deque = deque(maxlen=latency_samples)
+        self.delivered = 0
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+        for name, button in self.buttons.items():
+            # Default arguments bind the name, the callbacks are not re-registered afterwards
+            button.when_pressed = lambda name=name: self.on_edge(name, True)
+            button.when_released = lambda name=name: self.on_edge(name, False)
+            button.when_held = lambda name=name: self.on_held(name)
+        return None
+
+    def stop(self) -> None:
+        for button in self.buttons.values():
+            button.when_pressed = None
+            button.when_released = None
+            button.when_held = None
+        self.loop = None
+        return None
+
+    def on_edge(self, name: str, pressed: bool) -> None:
+        self.deliver(self.detector.edge(name, pressed))
+        return None
+
+    def on_held(self, name: str) -> None:
+        self.deliver(self.detector.held(name))
+        return None
+
+    def deliver(self, gesture: Optional[ButtonGesture]) -> None:
+        loop = self.loop
+        if gesture is None or loop is None:
+            return None
+        loop.call_soon_threadsafe(self.dispatch, gesture)
+        return None
+
+    def dispatch(self, gesture: ButtonGesture) -> None:
+        self.latency.append(time.monotonic() - gesture.edge)
+        self.delivered += 1
+        try:
+            self.handler(gesture)
+        except Exception as e:
+            print(f"Button handler for {gesture.kind} failed: ", e)
+        return None
+
+    def latency_ms(self) -> Optional[float]:
+        """Average edge-to-handler latency of the recent gestures, in milliseconds."""
+        if not self.latency:
+            return None
+        return sum(self.latency) / len(self.latency) * 1000
+
+async def main():
+    """
+    Test harness on gpiozero's mock pin factory, run from src with `python3 buttons.py`.
+    Presses, bounces, holds and chords the mock pins and reports the edge-to-handler latency.
+    """
+    from gpiozero import Button, Device
+    from gpiozero.pins.mock import MockFactory
+    Device.pin_factory = MockFactory()
+    long_press = 0.3
+    buttons = {
+        "measure": Button(17, pull_up=True, hold_time=long_press),
+        "white": Button(27, pull_up=True, hold_time=long_press),
+        "dark": Button(22, pull_up=True, hold_time=long_press),
+    }
+    pins = {name: button.pin for name, button in buttons.items()}
+    received = []
+    button_input = ButtonInput(buttons, received.append, GestureDetector(debounce=0.03, long_press=long_press))
+    button_input.start(asyncio.get_running_loop())
+
+    def press(name):
+        pins[name].drive_low()
+
+    def release(name):
+        pins[name].drive_high()
+
+    async def settle(seconds=0.05):
+        # Lets the loop run the delivered callbacks
+        await asyncio.sleep(seconds)
+
+    for _ in range(20):
+        press("measure")
+        await settle(0.06)
+        release("measure")
+        await settle()
+    # Bouncing contact: the edges within the debounce window are ignored
+    for pressed in (True, False, True, False, True):
+        (press if pressed else release)("measure")
+        await settle(0.002)
+    await settle(0.05)
+    release("measure")
+    await settle()
+    # Chord of white reference and measure, released in the other order
+    press("white")
+    await settle()
+    press("measure")
+    await settle()
+    release("white")
+    await settle()
+    release("measure")
+    await settle()
+    # Long press, the release ends it without a press
+    press("dark")
+    await settle(long_press + 0.1)
+    release("dark")
+    await settle()
+
+    kinds = [(g.kind, "+".join(sorted(g.buttons))) for g in received]
+    print(f"{kinds.count(('press', 'measure'))} presses, then: {kinds[20:]}")
+    print(f"{button_input.detector.bounced} bounced edges ignored")
+    print(f"Edge to handler latency: {button_input.latency_ms():.3f} ms over {len(button_input.latency)} gestures")
+    button_input.stop()
+    return
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,238 @@
+import math
+import os
+import time
+from dataclasses import dataclass
+from typing import Optional
+import numpy as np
+
+REFERENCES_PATH = "../references.npz"
+WHITE = "w"
+DARK = "b"
+
+@dataclass
+class Reference:
+    kind: str
+    spectrum: np.ndarray
+    # Sensor temperature (St) when the reference was taken, NaN if it could not be read
+    temperature: float
+    # Unix time of the capture
+    time: float
+
+@dataclass
+class Selection:
+    """The reference chosen for one kind at the current temperature."""
+    spectrum: Optional[np.ndarray]
+    # Identifies the references and weight the spectrum was built from
+    key: tuple
+    # False if the nearest reference is further than max_drift from the current temperature
+    valid: bool
+    # Current temperature minus the temperature of the nearest reference, None if unknown
+    drift: Optional[float]
+
+class CalibrationManager():
+    """
+    Library of white and dark references, picked by sensor temperature.
+
+    Every reference is stored with the sensor temperature and time it was captured.
+    The library keeps the latest `max_per_kind` references of each kind in an npz file,
+    written through a temporary file, so a restart finds the references of the last
+    session. References older than `max_age` seconds are not used.
+
+    `select()` picks the reference for the current temperature: if references were
+    taken on both sides of it, at most 2 * `max_drift` apart, they are interpolated
+    linearly, otherwise the nearest one is used. If even the nearest one is more than
+    `max_drift` degrees away the selection is marked invalid, the device then asks for
+    a recalibration.
+
+    A new reference supersedes the older ones of its kind: the first one of a session
+    replaces those restored from disk, later ones replace those within `max_drift` of
+    their temperature. Only references taken at clearly different temperatures in the
+    same session remain to interpolate with. A reference taken while the temperature
+    could not be read is used as is and gets the temperature of the next successful
+    reading, see `assign_temperature()`.
+
+    Usage Example:
+    ```
+    calibration = CalibrationManager()
+    calibration.add(WHITE, white_counts, temperature=31.0)
+    white = calibration.select(WHITE, temperature=32.5)
+    if not white.valid:
+        ...  # prompt for a new white reference
+    ```
+    """
+
+    def __init__(self, path: str = REFERENCES_PATH, max_per_kind: int = 6,
+                 max_drift: float = 3.0, max_age: float = 24 * 3600) -> None:
+        self.path = path
+        self.max_per_kind = max_per_kind
+        self.max_drift = max_drift
+        self.max_age = max_age
+        self.references: dict[str, list[Reference]] = {WHITE: [], DARK: []}
+        # Kinds a reference was added for since start
+        self.session_kinds: set[str] = set()
+        # References of this session still waiting for a temperature reading
+        self.unassigned: list[Reference] = []
+        self.load()
+
+    def load(self) -> None:
+        try:
+            with np.load(self.path) as library:
+                for kind in self.references:
+                    spectra = library[f"{kind}_spectra"]
+                    temperatures = library[f"{kind}_temperatures"]
+                    times = library[f"{kind}_times"]
+                    self.references[kind] = [
+                        Reference(kind, spectrum, float(temperature), float(timestamp))
+                        for spectrum, temperature, timestamp in zip(spectra.astype(np.float32), temperatures, times)
+                    ]
+        except (OSError, KeyError, ValueError) as e:
+            if os.path.exists(self.path):
+                print("Failed to load the reference library: ", e)
+            return None
+        print(f"Loaded {len(self.references[WHITE])} white and {len(self.references[DARK])} dark references")
+        return None
+
+    def save(self) -> None:
+        arrays = {}
+        for kind, references in self.references.items():
+            if references:
+                arrays[f"{kind}_spectra"] = np.stack([r.spectrum for r in references]).astype(np.float32)
+            else:
+                arrays[f"{kind}_spectra"] = np.empty((0, 0), dtype=np.float32)
+            arrays[f"{kind}_temperatures"] = np.array([r.temperature for r in references], dtype=np.float64)
+            arrays[f"{kind}_times"] = np.array([r.time for r in references], dtype=np.float64)
+        # np.savez appends .npz to names without it, the temporary name keeps the suffix
+        tmp_path = self.path + ".tmp.npz"
+        try:
+            np.savez(tmp_path, **arrays)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print("Failed to save the reference library: ", e)
+        return None
+
+    def add(self, kind: str, spectrum, temperature: Optional[float], timestamp: Optional[float] = None) -> None:
+        reference = Reference(
+            kind,
+            np.array(spectrum, dtype=np.float32),
+            math.nan if temperature is None else float(temperature),
+            time.time() if timestamp is None else timestamp,
+        )
+        if kind not in self.session_kinds:
+            # A recalibration takes full effect, nothing of an earlier session is blended in
+            self.references[kind] = []
+            self.session_kinds.add(kind)
+        if math.isnan(reference.temperature):
+            self.unassigned.append(reference)
+        else:
+            self.supersede(reference)
+        references = self.references[kind]
+        references.append(reference)
+        del references[:-self.max_per_kind]
+        self.save()
+        return None
+
+    def supersede(self, reference: Reference) -> None:
+        """Drops the other references of its kind taken within `max_drift` of its temperature, or without one."""
+        # Compared by identity, == on the dataclass would compare the spectra
+        self.references[reference.kind] = [
+            r for r in self.references[reference.kind]
+            if r is reference or abs(r.temperature - reference.temperature) > self.max_drift
+        ]
+        self.unassigned = [r for r in self.unassigned if r is reference or r.kind != reference.kind]
+        return None
+
+    def assign_temperature(self, temperature: float) -> None:
+        """Gives the references taken while the temperature could not be read the temperature read now."""
+        if not self.unassigned:
+            return None
+        for reference in self.unassigned:
+            reference.temperature = float(temperature)
+        # Newest first, a later reference supersedes an earlier one at the same temperature
+        for reference in reversed(self.unassigned):
+            # Skips references a later one of the same kind superseded meanwhile
+            if any(r is reference for r in self.references[reference.kind]):
+                self.supersede(reference)
+        self.unassigned = []
+        self.save()
+        return None
+
+    def usable(self, kind: str, now: Optional[float] = None) -> list[Reference]:
+        """The references of `kind` young enough to use, newest first."""
+        now = time.time() if now is None else now
+        return [r for r in reversed(self.references[kind]) if now - r.time <= self.max_age]
+
+    def select(self, kind: str, temperature: Optional[float], now: Optional[float] = None) -> Selection:
+        references = self.usable(kind, now)
+        if not references:
+            return Selection(None, (), False, None)
+        measured = [r for r in references if not math.isnan(r.temperature)]
+        pending = any(r is references[0] for r in self.unassigned)
+        if temperature is None or not measured or pending:
+            # No temperature to compare, or the newest reference still waits for its own, it is used as is
+            newest = references[0]
+            return Selection(newest.spectrum, (newest.time,), True, None)
+
+        # min() keeps the first of equal candidates, the newest
+        nearest = min(measured, key=lambda r: abs(temperature - r.temperature))
+        drift = temperature - nearest.temperature
+        below = [r for r in measured if r.temperature <= temperature]
+        above = [r for r in measured if r.temperature > temperature]
+        if below and above:
+            low = min(below, key=lambda r: temperature - r.temperature)
+            high = min(above, key=lambda r: r.temperature - temperature)
+            if high.temperature - low.temperature <= 2 * self.max_drift:
+                weight = (temperature - low.temperature) / (high.temperature - low.temperature)
+                # Rounded, so small temperature changes do not rebuild the reference every scan
+                weight = round(weight * 20) / 20
+                spectrum = (1 - weight) * low.spectrum + weight * high.spectrum
+                return Selection(spectrum.astype(np.float32), (low.time, high.time, weight), True, drift)
+        return Selection(nearest.spectrum, (nearest.time,), abs(drift) <= self.max_drift, drift)
+
+    def status(self, temperature: Optional[float]) -> str:
+        """`<kind>:<drift or ?>:<ok|recal>` per kind, e.g. `w:+1.5:ok|b:-4.0:recal`, `none` for no reference."""
+        parts = []
+        for kind in (WHITE, DARK):
+            selection = self.select(kind, temperature)
+            if selection.spectrum is None:
+                parts.append(f"{kind}:none:recal")
+                continue
+            drift = "?" if selection.drift is None else f"{selection.drift:+.1f}"
+            parts.append(f"{kind}:{drift}:{'ok' if selection.valid else 'recal'}")
+        return "|".join(parts)
+
+def main():
+    """
+    Test harness with synthetic references, run from src with `python3 calibration.py`.
+    Builds a library at two temperatures, reloads it and selects references across a temperature sweep,
+    then recalibrates the white reference with a failed temperature reading.
+    """
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), "references.npz")
+    calibration = CalibrationManager(path)
+    wavelengths = np.linspace(0, 1, 512)
+    for temperature in (30.0, 34.0):
+        # White counts drop by 1 % per degree
+        calibration.add(WHITE, 1000 * (1 - 0.01 * (temperature - 30)) * (1 + wavelengths), temperature)
+        calibration.add(DARK, np.full(512, 50 + temperature), temperature)
+    reloaded = CalibrationManager(path)
+    for temperature in (None, 30.0, 32.0, 33.0, 36.0, 38.0):
+        white = reloaded.select(WHITE, temperature)
+        print(f"{temperature}: white[0] {white.spectrum[0]:.1f}, key {white.key[1:] or white.key}, "
+              f"status {reloaded.status(temperature)}")
+
+    def white(temperature):
+        return 1000 * (1 - 0.01 * (temperature - 30)) * (1 + wavelengths)
+    # St failed after the scan: the new white is used right away and replaces the restored ones
+    reloaded.add(WHITE, white(32.0), None)
+    print("Recalibrated without a temperature: ", f"white[0] {reloaded.select(WHITE, 30.0).spectrum[0]:.1f},",
+          f"{len(reloaded.references[WHITE])} white reference(s)")
+    reloaded.assign_temperature(32.0)
+    reloaded.add(WHITE, white(36.5), 36.5)
+    # Within max_drift of the 32.0 reference, which it replaces
+    reloaded.add(WHITE, white(33.0), 33.0)
+    temperatures = [r.temperature for r in CalibrationManager(path).references[WHITE]]
+    print(f"White references after recalibrating: {temperatures}, status at 33.5 {reloaded.status(33.5)}")
+    return
+
+if __name__ == "__main__":
+    main()
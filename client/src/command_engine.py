@@ -0,0 +1,105 @@
+from typing import Any, Callable, Optional
+from serial_transport import SerialTransport
+
+def reply_value(reply: str) -> str:
+    """Returns the value part of a reply, the sensor prefixes some values with `<name>:`."""
+    if ":" in reply:
+        return reply.split(":", 1)[1].strip()
+    return reply.strip()
+
+def parse_text(reply: str) -> str:
+    return reply_value(reply)
+
+def parse_int(reply: str) -> int:
+    return int(float(reply_value(reply)))
+
+def parse_float(reply: str) -> float:
+    return float(reply_value(reply))
+
+def parse_floats(reply: str) -> tuple[float, ...]:
+    return tuple(float(v) for v in reply_value(reply).split(","))
+
+def parse_ack(reply: str) -> bool:
+    return True
+
+# Reply parsers keyed by the command descriptions of SerialDevice.CMDS.
+# Commands that are not listed here are returned as text.
+REPLY_PARSERS: dict[str, Callable[[str], Any]] = {
+    "Sensor Type": parse_text,
+    "Hardware Version": parse_text,
+    "Serial Number": parse_text,
+    "Minimum Wavelength": parse_float,
+    "Maximum Wavelength": parse_float,
+    "Firmware Version (?)": parse_text,
+    "Number Of Wavelengths": parse_int,
+    "Measurement Time 1": parse_float,
+    "Measurement Time 2": parse_float,
+    "Measurement Time 3": parse_float,
+    "Light Source Power Level 0": parse_ack,
+    "Light Source Power Level 100": parse_ack,
+    "Light Source Warm-Up Time": parse_float,
+    "Measurement Ready": parse_ack,
+    "Temperature Value": parse_float,
+    "Current1 (mA), Current2 (mA)": parse_floats,
+    "Slope Value, Bias Value": parse_floats,
+    "Smoothing Function Value, Parameter Value": parse_floats,
+    "Index Value, Coefficient Value": parse_floats,
+}
+
+class CommandEngine():
+    """
+    Queues Nirone commands and exchanges them with the sensor in a single round.
+
+    Each reply is matched to its command by position and parsed into a typed value,
+    so reading e.g. temperature and currents costs one write and one read pass
+    instead of a blocking, flushed exchange per command.
+
+    Usage Example:
+    ```
+    engine = CommandEngine(transport, serial_device.CMDS)
+    engine.queue("Temperature Value")
+    engine.queue("Current1 (mA), Current2 (mA)")
+    values = await engine.run()
+    # {"Temperature Value": 32.0, "Current1 (mA), Current2 (mA)": (120.0, 118.0)}
+    ```
+    """
+
+    def __init__(self, transport: SerialTransport, cmds: dict[str, str]) -> None:
+        self.transport = transport
+        self.CMDS = cmds
+        self.pending: list[tuple[str, str]] = []
+        pass
+
+    def queue(self, name: str, **params) -> None:
+        """Queues the command `name` from CMDS, formatting it with `params` when it takes any."""
+        cmd = self.CMDS[name].format(**params) if params else self.CMDS[name]
+        self.pending.append((name, cmd))
+        return None
+
+    async def run(self, timeout: float = 2.0) -> dict[str, Any]:
+        """
+        Sends every queued command in one batch and returns the parsed replies keyed by command name.
+
+        A reply that can not be parsed is returned as None, transport errors are raised to the caller.
+        """
+        pending, self.pending = self.pending, []
+        if not pending:
+            return {}
+        replies = await self.transport.batch([cmd for _, cmd in pending], timeout=timeout)
+        results = {}
+        for (name, _), reply in zip(pending, replies):
+            results[name] = self.parse(name, reply)
+        return results
+
+    async def query(self, *names: str, timeout: float = 2.0) -> dict[str, Any]:
+        for name in names:
+            self.queue(name)
+        return await self.run(timeout=timeout)
+
+    def parse(self, name: str, reply: str) -> Optional[Any]:
+        parser = REPLY_PARSERS.get(name, parse_text)
+        try:
+            return parser(reply)
+        except ValueError:
+            print(f"Failed to parse reply to '{name}': {reply!r}")
+            return None
@@ -0,0 +1,111 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Any, Awaitable, Callable, Optional
+
+class DeviceState(Enum):
+    IDLE = "idle"
+    CALIBRATING = "calibrating"
+    MEASURING = "measuring"
+    UPLOADING = "uploading"
+    INFERRING = "inferring"
+
+class EventType(Enum):
+    # Measure button pressed, the armed reference event decides the measurement type
+    MEASURE = "measure"
+    # A spectrum from the sensor is waiting in EventManager.received_data
+    DATA_READY = "data_ready"
+
+@dataclass
+class DeviceEvent:
+    type: EventType
+    # time.monotonic() of the input that started the chain of events, used for latency
+    origin: float = field(default_factory=time.monotonic)
+    payload: Any = None
+
+class EventDispatcher():
+    """
+    Typed event queue that drives the device state machine.
+
+    Inputs (buttons, BLE, serial completions) post DeviceEvents, and the dispatcher
+    wakes as soon as one arrives and awaits its registered handler. Events are handled
+    one at a time in arrival order. A MEASURE event that was posted while the device
+    was busy is dropped, like a button press during a measurement always was.
+
+    post() may be called from any thread.
+
+    The time from each event's origin to the end of its handler is kept per event
+    type, so e.g. the DATA_READY latency is the press-to-result time of a measurement.
+
+    Usage Example:
+    ```
+    dispatcher = EventDispatcher()
+    dispatcher.register(EventType.MEASURE, handle_measure)
+    loop.create_task(dispatcher.run())
+    dispatcher.post(DeviceEvent(EventType.MEASURE))
+    ```
+    """
+
+    def __init__(self, latency_samples: int = 20) -> None:
+        self.state = DeviceState.IDLE
+        self.handlers: dict[EventType, Callable[[DeviceEvent], Awaitable[None]]] = {}
+        self.latency: dict[EventType, deque] = {t: deque(maxlen=latency_samples) for t in EventType}
+        self.queue: Optional[asyncio.Queue] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread: Optional[int] = None
+        # Set whenever the state returns to IDLE, MEASURE events older than this are stale
+        self.idle_since = 0.0
+
+    def register(self, event_type: EventType, handler: Callable[[DeviceEvent], Awaitable[None]]) -> None:
+        self.handlers[event_type] = handler
+        return None
+
+    def set_state(self, state: DeviceState) -> None:
+        if state != self.state:
+            print(f"STATE: {self.state.value} -> {state.value}")
+            self.state = state
+            if state == DeviceState.IDLE:
+                self.idle_since = time.monotonic()
+        return None
+
+    def post(self, event: DeviceEvent) -> None:
+        if self.loop is None or self.queue is None:
+            print(f"Dispatcher not running, dropping {event.type.value}")
+            return None
+        if threading.get_ident() == self.loop_thread:
+            self.queue.put_nowait(event)
+        else:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, event)
+        return None
+
+    def latency_ms(self, event_type: EventType) -> Optional[float]:
+        """Average origin-to-handled latency of the recent events of `event_type`, in milliseconds."""
+        samples = self.latency[event_type]
+        if not samples:
+            return None
+        return sum(samples) / len(samples) * 1000
+
+    async def run(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.queue = asyncio.Queue()
+        self.idle_since = time.monotonic()
+        while True:
+            event = await self.queue.get()
+            if event.type == EventType.MEASURE and (self.state != DeviceState.IDLE or event.origin < self.idle_since):
+                print(f"Device busy, dropping {event.type.value}")
+                continue
+            handler = self.handlers.get(event.type)
+            if handler is None:
+                continue
+            try:
+                await handler(event)
+            except Exception as e:
+                print(f"Handler for {event.type.value} failed: ", e)
+                self.set_state(DeviceState.IDLE)
+            elapsed = time.monotonic() - event.origin
+            self.latency[event.type].append(elapsed)
+            print(f"{event.type.value} handled {elapsed * 1000:.1f} ms after origin")
@@ -14,4 +14,13 @@ class ENV:
     DEVICE_ID = os.getenv("DEVICE_ID")
     SHARED_KEY = os.getenv("SHARED_KEY")
     SHARED_SIGN_KEY = os.getenv("SHARED_SIGN_KEY")
-    SHARED_ENCR_KEY = os.getenv("SHARED_ENCR_KEY")
\ No newline at end of file
+    SHARED_ENCR_KEY = os.getenv("SHARED_ENCR_KEY")
+    SAVGOL_FILTER = os.getenv("SAVGOL_FILTER", "false").lower() == "true"
+    UPLOAD_FORMAT = os.getenv("UPLOAD_FORMAT", "auto").lower()
+    HISTORY_SPECTRA = os.getenv("HISTORY_SPECTRA", "false").lower() == "true"
+    BURST_SCANS = int(os.getenv("BURST_SCANS", "1"))
+    BURST_MODE = os.getenv("BURST_MODE", "mean").lower()
+    LAMP_IDLE_OFF = float(os.getenv("LAMP_IDLE_OFF", "10"))
+    CALIBRATION_MAX_DRIFT = float(os.getenv("CALIBRATION_MAX_DRIFT", "3"))
+    CALIBRATION_MAX_AGE = float(os.getenv("CALIBRATION_MAX_AGE", "24"))
+    BLE_REQUIRE_SESSION = os.getenv("BLE_REQUIRE_SESSION", "false").lower() == "true"
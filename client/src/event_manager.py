@@ -1,19 +1,40 @@
 # src/event_manager.py
 import asyncio
+import base64
+import numpy as np
+from typing import Optional
 from datetime import datetime, timezone
 from interface import APIClient
+from outbox import Outbox, OutboxUploader
 from serial_device import SerialDevice
 from hardware_class import LedControl
-from bt.bt_auth import BTAuth
+from bt.bt_auth import BTAuth, SESSION_HELLO
+from bt.bt_session import CHANNEL_NOTIFY
 from bsd_client import BSDClient
+from preprocessing import ReflectancePipeline
+from savgol import SavgolFilter
+from result_cache import ResultCache
+from dispatcher import EventDispatcher, DeviceEvent, DeviceState, EventType
+from ble_bridge import ReplyBoard, MAX_REPLY_MESSAGE
+from ble_transfer import KIND_RESULT, KIND_HISTORY, KIND_SPECTRUM, KIND_VARIANCE
+from history import MeasurementHistory, parse_labels
+from calibration import CalibrationManager, WHITE, DARK
 from env import ENV
 
+# Longest time the BLE thread waits for the event loop to handle a write
+BLE_HANDLER_TIMEOUT = 2.0
+# Replies of a sample without a classification, they carry no labels for the history
+NO_RESULT = "No result"
+RECALIBRATION_NEEDED = "Recalibration needed"
+
 class EventManager():
     def __init__(self) -> None:
         
         
         # Networking utility
         self.api_client = APIClient(self)
+        self.outbox = Outbox()
+        self.uploader = OutboxUploader(self.outbox, self.api_client)
         self.send_measurement = asyncio.Event()
         self.received_data = asyncio.Queue()
         self.server_response = "No measurements"
@@ -26,170 +47,301 @@ class EventManager():
         
         
         # Sensor measurement utility
-        self.measure_event = asyncio.Event()
+        self.dispatcher = EventDispatcher()
+        self.dispatcher.register(EventType.MEASURE, self.hw_event_handler)
+        self.dispatcher.register(EventType.DATA_READY, self.data_event_handler)
         self.white_ref_event = asyncio.Event()
         self.backgr_rad_event = asyncio.Event()
-        self.white_ref_values = []
-        self.backgr_rad_values = []
-        self.measure_history = []
+        self.reflectance = ReflectancePipeline()
+        # Params from Model / ThesisBase, off unless the model was trained on smoothed spectra
+        self.smoothing = SavgolFilter(window_length=30, polyorder=3) if ENV.SAVGOL_FILTER else None
+        self.history = MeasurementHistory(store_spectra=ENV.HISTORY_SPECTRA)
+        self.result_cache = ResultCache()
         
         # Bluetooth utility
-        self.bt_auth = BTAuth((str(ENV.SHARED_SIGN_KEY)), (str(ENV.SHARED_ENCR_KEY)))
+        self.bt_auth = BTAuth((str(ENV.SHARED_SIGN_KEY)), (str(ENV.SHARED_ENCR_KEY)), ENV.BLE_REQUIRE_SESSION)
         self.white_ref_calibrated = False
         self.backgr_rad_calibrated = False
-        self.uart_rx_reader_field: bytearray
+        # References by sensor temperature, kept on disk across restarts
+        self.calibration = CalibrationManager(max_drift=ENV.CALIBRATION_MAX_DRIFT, max_age=ENV.CALIBRATION_MAX_AGE * 3600)
+        self.calibration_key: Optional[tuple] = None
+        self.replies = ReplyBoard(self.bt_auth)
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        # TxCharacteristic, set once the GATT application is registered
+        self.ble_tx = None
+        self.last_spectrum: Optional[np.ndarray] = None
         
         # Local inference utility
         self.bsd_client = BSDClient()
         
     async def clear_events(self):
-        self.measure_event.clear()
         self.white_ref_event.clear()
         self.backgr_rad_event.clear()
 
-    async def start_measurement(self, type: str):
+    async def start_measurement(self, type: str) -> bool:
         await self.led_control.on()
         self.in_progress = True
         await self.serial_device.shared_objects(self.received_data, self.send_measurement)
-        await self.serial_device.measure(type)
-        await self.send_measurement.wait()
+        measured = await self.serial_device.measure(type, ENV.BURST_SCANS)
+        if measured:
+            await self.send_measurement.wait()
         await self.clear_events()
         self.in_progress = False
         await self.led_control.off()
+        if not measured:
+            print("Measurement failed, nothing was received from the sensor")
+            loop = asyncio.get_event_loop()
+            loop.create_task(self.led_control.blink_red())
         print("Done meas")
+        return measured
+
+    def apply_calibration(self) -> None:
+        """
+        Selects the references for the last sensor temperature and hands them to the reflectance pipeline.
+
+        The calibrated flags follow the selection, a reference that drifted too far asks for recalibration.
+        """
+        temperature = self.serial_device.sensor_temperature
+        if temperature is not None:
+            # References taken while St failed get the first temperature read after them
+            self.calibration.assign_temperature(temperature)
+        white = self.calibration.select(WHITE, temperature)
+        dark = self.calibration.select(DARK, temperature)
+        if (self.white_ref_calibrated and not white.valid) or (self.backgr_rad_calibrated and not dark.valid):
+            print(f"---\nRECALIBRATION NEEDED\n{self.calibration.status(temperature)}\n---")
+        self.white_ref_calibrated = white.valid
+        self.backgr_rad_calibrated = dark.valid
+        key = (white.key, dark.key)
+        # Only a changed selection is applied, each reference bumps the pipeline's generation
+        if key != self.calibration_key:
+            if white.spectrum is not None:
+                self.reflectance.set_white(white.spectrum)
+            if dark.spectrum is not None:
+                self.reflectance.set_dark(dark.spectrum)
+            self.calibration_key = key
+        return None
 
-    async def hw_event_handler(self):
+    async def hw_event_handler(self, event: DeviceEvent):
         # Main measure button pressed
-        if self.measure_event.is_set():
-            # If calibration event was set
-            if self.white_ref_event.is_set():
-                print("MEASURE WHITEREF")
-                self.previous_event = "w"
-                await self.start_measurement("w")
+        # Re-checked against the temperature of the last scan, drifted references need a recalibration
+        self.apply_calibration()
+        # If calibration event was set
+        if self.white_ref_event.is_set():
+            print("MEASURE WHITEREF")
+            measurement_type = "w"
+            self.dispatcher.set_state(DeviceState.CALIBRATING)
+        elif self.backgr_rad_event.is_set():
+            print("MEASURE BACKGR RAD")
+            measurement_type = "b"
+            self.dispatcher.set_state(DeviceState.CALIBRATING)
+        # Else Normal measurement
+        elif (self.white_ref_calibrated & self.backgr_rad_calibrated):
+            print("MEASURE NORMAL")
+            measurement_type = "m"
+            self.dispatcher.set_state(DeviceState.MEASURING)
+        else:
+            print("---\nNON-CALIBRATED\nCALIBRATE BEFORE MEASURE NORMAL\n---")
+            loop = asyncio.get_event_loop()
+            loop.create_task(self.led_control.blink_red())
+            self.previous_event = ""
+            await self.clear_events()
+            return
+        self.previous_event = measurement_type
+        if await self.start_measurement(measurement_type):
+            if measurement_type == "w":
                 self.white_ref_calibrated = True
-                return
-            elif self.backgr_rad_event.is_set():
-                print("MEASURE BACKGR RAD")
-                self.previous_event = "b"
-                await self.start_measurement("b")
+            elif measurement_type == "b":
                 self.backgr_rad_calibrated = True
-                return
-            # Else Normal measurement
-            else:
-                if (self.white_ref_calibrated & self.backgr_rad_calibrated):
-                    print("MEASURE NORMAL")
-                    self.previous_event = "m"
-                    await self.start_measurement("m")
-                else:
-                    print("---\nNON-CALIBRATED\nCALIBRATE BEFORE MEASURE NORMAL\n---")
-                    loop = asyncio.get_event_loop()
-                    loop.create_task(self.led_control.blink_red())
-                    self.previous_event = ""
-                    await self.clear_events()
-
-    def ev_done_callback(self, task):
-        history_length = len(self.measure_history)
-        if history_length > 5:
-            self.measure_history.pop(history_length-1)
-        self.measure_history.insert(0,
-            {
-            "time": int(datetime.now(tz=timezone.utc).timestamp()),
-            "labels": self.server_response,
-            }
-        )
-
-    async def api_event_handler(self):
-        # We check first if API Client has initiated succesfully
-        # and server is reachable
-        if (self.api_client.status_active):
-            if not self.received_data.empty():
-                data = await self.received_data.get()
-                packet = {
-                    'data': data,
-                    'time': int(datetime.now(tz=timezone.utc).timestamp()), 
-                    'id': int(str(ENV.DEVICE_ID)),
-                    'type': self.previous_event,
-                }
-                await asyncio.wait_for(self.api_client.send_data_to_api(packet), timeout=5000)
+            self.dispatcher.post(DeviceEvent(EventType.DATA_READY, origin=event.origin))
+        else:
+            self.dispatcher.set_state(DeviceState.IDLE)
+
+    async def data_event_handler(self, event: DeviceEvent):
+        measure_type = self.previous_event
+        spectrum = None
+        if self.api_client.status_active:
+            self.dispatcher.set_state(DeviceState.UPLOADING)
+        elif self.previous_event == "m":
+            self.dispatcher.set_state(DeviceState.INFERRING)
+        try:
+            spectrum = await self.api_event_handler()
+            if spectrum is not None:
+                self.last_spectrum = spectrum
+            # Encrypted now so the next poll_Label only has to publish it
+            self.replies.precompute(self.server_response)
+            if measure_type == "m":
+                self.push_to_app(KIND_RESULT, self.server_response)
+        finally:
+            self.record_history(measure_type, spectrum, self.serial_device.last_variance)
+            self.dispatcher.set_state(DeviceState.IDLE)
+
+    def record_history(self, measure_type: str, spectrum, variance=None) -> None:
+        if not measure_type:
+            return None
+        # References have no result, server_response still holds the previous sample's
+        labels = parse_labels(self.server_response) if measure_type == "m" else []
+        # The burst variance stays on the device, the API has no field for it and gets the averaged spectrum only
+        self.history.append(measure_type, labels, spectrum, int(datetime.now(tz=timezone.utc).timestamp()), variance)
+        return None
+
+    def preprocess(self, data) -> np.ndarray:
+        # Reflectance scaled to 0... 1, written into the pipeline's own buffer
+        scaled_reflectance = self.reflectance.process(data)
+        if self.smoothing is not None:
+            scaled_reflectance = self.smoothing.apply(scaled_reflectance)
+        return scaled_reflectance
+
+    async def api_event_handler(self) -> Optional[np.ndarray]:
+        """Uploads or classifies the spectrum waiting in received_data and returns it, None if there was none."""
+        if self.received_data.empty():
+            return None
+        data = await self.received_data.get()
+        packet = {
+            # Serialized by APIClient in the format the API negotiated
+            'data': data,
+            'time': int(datetime.now(tz=timezone.utc).timestamp()), 
+            'id': int(str(ENV.DEVICE_ID)),
+            'type': self.previous_event,
+        }
+        # Every raw spectrum is stored until the API has it, so nothing is lost while offline
+        row_id = self.outbox.append(packet)
+        # References are kept locally as well, local inference needs them whenever the API is unreachable
+        # The sensor temperature was read right after the scan
+        temperature = self.serial_device.sensor_temperature
+        if (self.previous_event == "w"):
+            print("White Reference values saved")
+            self.calibration.add(WHITE, data, temperature)
+        elif (self.previous_event == "b"):
+            print("Background Reference values saved")
+            self.calibration.add(DARK, data, temperature)
+        self.apply_calibration()
+        if (self.previous_event == "m"):
+            # Every sample gets its own reply, a failed upload or inference must not repeat the previous result
+            self.server_response = NO_RESULT
+            if not (self.white_ref_calibrated & self.backgr_rad_calibrated):
+                # The temperature read after this scan is too far from the references, the scan is still queued for the API
+                print("Sample measured with drifted references: ", self.calibration.status(temperature))
+                self.server_response = RECALIBRATION_NEEDED
+                self.uploader.kick()
                 self.send_measurement.clear()
                 self.previous_event = ""
-            else:
-                pass
-        # As a fallback method, we can run inference on local model
-        # Also handling any mathematical operations needed.
-        else:
-            if not self.received_data.empty():
-                data = await self.received_data.get()
-                print("RECV DATA: ", data)
-                print("DATA TYPE: ", type(data))
-                if (self.previous_event == "w"):
-                    print("White Reference values saved")
-                    self.white_ref_values = data
-                elif (self.previous_event == "b"):
-                    print("Background Reference values saved")
-                    self.backgr_rad_values = data
-                elif (self.previous_event == "m"): # We are currently running measurement that we want to predict
-                    # This is dependant on reference values.
-                    print("Calculating Reflectance")
-                    print(type(self.white_ref_values))
-                    print("WHITE REF LIST", len(self.white_ref_values), "BACKGR RAD LIST: ", len(self.backgr_rad_values))
-                    if (self.white_ref_calibrated & self.backgr_rad_calibrated):
-                        try: 
-                            reflectance = [(m - d) / (w - d) for m, w, d in zip(data, self.white_ref_values, self.backgr_rad_values)]
-                            print("minmax")
-                            min_reflectance = min(reflectance)
-                            max_reflectance = max(reflectance)
-                            print("Scaling to 0... 1 ...")
-                            scaled_reflectance = [(a - min_reflectance) / (max_reflectance - min_reflectance) for a in reflectance]
-                            # Todo: Apply savgol filter (simplify based on https://github.com/scipy/scipy/blob/v1.15.3/scipy/signal/_savitzky_golay.py)
-                            # use Params from Model / ThesisBase
-                            self.server_response = self.bsd_client.local_inference(scaled_reflectance)
-                        except Exception as e:
-                            print("Failed to pre-treat sensor data: ", e)
-                
-                # Then we reset objects for next measurement
+                return data
+
+        # Sent straight away only when nothing older is queued, the API must get references before samples
+        direct = self.api_client.status_active and self.outbox.count == 1
+        scaled_reflectance = None
+        fingerprint = None
+        if (self.previous_event == "m") and self.reflectance.is_calibrated:
+            scaled_reflectance = self.preprocess(data)
+            fingerprint = self.result_cache.fingerprint(scaled_reflectance)
+            version = self.api_client.model_version if direct else self.bsd_client.model_version
+            cached = self.result_cache.get(self.result_cache.key(fingerprint, version, self.reflectance.generation))
+            if cached is not None:
+                # A rescan of a swatch that was just classified, the API still gets it from the outbox
+                print("Result cache hit: ", self.result_cache.stats())
+                self.server_response = cached
+                self.uploader.kick()
                 self.send_measurement.clear()
                 self.previous_event = ""
+                return data
+
+        uploaded = False
+        if direct:
+            uploaded = await self.api_client.send_data_to_api(packet)
+            if uploaded:
+                self.outbox.remove([row_id])
+                if fingerprint is not None:
+                    self.result_cache.put(self.result_cache.key(fingerprint, self.api_client.model_version, self.reflectance.generation), self.server_response)
+        if not uploaded:
+            self.uploader.kick()
+            # As a fallback method, we can run inference on local model
+            if (self.previous_event == "m"): # We are currently running measurement that we want to predict
+                # This is dependant on reference values.
+                if (self.white_ref_calibrated & self.backgr_rad_calibrated) and scaled_reflectance is not None:
+                    try: 
+                        self.server_response = await self.bsd_client.local_inference(scaled_reflectance)
+                        # Asked after the call, the model version is only known once connected
+                        key = self.result_cache.key(fingerprint, self.bsd_client.model_version, self.reflectance.generation)
+                        self.result_cache.put(key, self.server_response)
+                    except Exception as e:
+                        print("Failed to pre-treat sensor data: ", e)
+
+        # Then we reset objects for next measurement
+        self.send_measurement.clear()
+        self.previous_event = ""
+        return data
     
     async def wait_for_events(self):
         loop = asyncio.get_event_loop()
+        self.loop = loop
         loop.create_task(self.led_control.startup_notification())
+        # Registers with the API in the background, measurements run locally until it succeeds
+        self.api_client.start()
+        loop.create_task(self.uploader.run())
+        # References of an earlier session are usable if the sensor is still at their temperature
+        try:
+            await self.serial_device.read_sensor_status()
+            self.apply_calibration()
+        except Exception as e:
+            print("Failed to restore the references: ", e)
         print("Falling into event loop")
-        while True:
-            await asyncio.sleep(1)
-            if not self.in_progress:
-                loop.create_task(self.hw_event_handler())
+        try:
+            await self.dispatcher.run()
+        finally:
+            if not await self.serial_device.lamp.off():
+                print("Failed to switch the lamp off on exit")
+            await self.api_client.close()
+            self.outbox.close()
+            self.history.close()
 
-            if self.send_measurement.is_set():
-                task = loop.create_task(self.api_event_handler())
-                task.add_done_callback(self.ev_done_callback)
-                await task
+    def messager(self, message: bytes) -> None:
+        """
+        Called by RxCharacteristic.WriteValue on the GLib thread.
 
-    def messager(self, message: str) -> None:
+        The message is decrypted here and then handled on the asyncio loop, so the event
+        flags and replies are only ever touched from the loop thread. The write returns
+        once the reply has been published, so a read that follows it gets the new reply.
+        """
         print("Messager: ", message)
         result = self.bt_auth.decrypt_message(message)
         print("Parse result: ", result)
-        if (result != ""):
-            print("Creating task...")
-            try:
-                self.parser(result)
-            except Exception as e:
-                print("Error while starting: ", e)
+        if (result == ""):
+            return
+        if self.loop is None:
+            print("Event loop not running, dropping BLE message")
+            return
+        future = asyncio.run_coroutine_threadsafe(self.handle_message(result), self.loop)
+        try:
+            future.result(timeout=BLE_HANDLER_TIMEOUT)
+        except Exception as e:
+            print("Error while handling BLE message: ", e)
         return
 
+    async def handle_message(self, msg: str) -> None:
+        self.parser(msg)
+        return None
+
     def reader(self, message: str) -> None:
-        # Define default on exceptions
-        try:
-            encrypted_message = self.bt_auth.encrypt_message(message)
-            result = bytearray(encrypted_message.encode())
-            print("Setting to result: ", result)
-            self.uart_rx_reader_field = result
-        except:
-            pass
+        self.replies.publish(message)
         return
+
+    def push_to_app(self, kind: int, message: str) -> None:
+        """Sends an encrypted message to the app as Tx notifications, if it has subscribed to them."""
+        if self.ble_tx is None:
+            return None
+        try:
+            self.ble_tx.push(kind, self.replies.prepare(message, CHANNEL_NOTIFY))
+        except Exception as e:
+            print("Failed to push BLE message: ", e)
+        return None
     
     def parser(self, msg: str):
-        if (msg == "poll_Label"):
+        if msg.startswith(SESSION_HELLO):
+            # Answered in the envelope the hello came in, the app needs the ack to derive the session keys
+            print("Session handshake")
+            self.reader(self.bt_auth.start_session(msg[len(SESSION_HELLO):]))
+
+        elif (msg == "poll_Label"):
             print("LabelPoll")
             self.reader(self.server_response)
         
@@ -221,13 +373,38 @@ class EventManager():
             print("Setting temp to rx: ", temp)
             self.reader(temp)
             
-        elif (msg == "list_History"):
+        elif (msg == "i_Calibration"):
+            # Drift of the selected references from the current temperature, see CalibrationManager.status
+            self.reader(self.calibration.status(self.serial_device.sensor_temperature))
+
+        elif (msg == "i_Lamp"):
+            # <state>|<seconds on since start>|<switch-ons>|<scans that found the lamp warm>
+            try:
+                self.reader(self.serial_device.lamp.stats())
+            except Exception as e:
+                print("Failed to get lamp state: ", e)
+
+        elif (msg == "stream_History"):
+            # The whole history in one chunked transfer instead of paging through list_History
+            self.push_to_app(KIND_HISTORY, self.history.encode(1 << 16))
+
+        elif (msg == "stream_Spectrum"):
+            if self.last_spectrum is not None:
+                spectrum = np.asarray(self.last_spectrum, dtype="<f4").tobytes()
+                self.push_to_app(KIND_SPECTRUM, base64.b64encode(spectrum).decode())
+
+        elif (msg == "stream_Variance"):
+            # Per wavelength variance of the last burst, same encoding as stream_Spectrum under its own kind
+            variance = self.serial_device.last_variance
+            if variance is not None:
+                self.push_to_app(KIND_VARIANCE, base64.b64encode(np.asarray(variance, dtype="<f4").tobytes()).decode())
+
+        elif (msg == "list_History" or msg.startswith("list_History:")):
+            # "list_History:<offset>" asks for the page starting at the offset the previous reply gave
             print("Listing history")
             try:
-                print("To be done")
-                # TODO:
-                # Make self.measure_history format to string from dict list and return in server response
-                # Check for string length boundaries
+                offset = int(msg.partition(":")[2] or 0)
+                self.reader(self.history.encode(MAX_REPLY_MESSAGE, offset))
             except Exception as e:
                 print("Failed to return history list: ", e)
             
\ No newline at end of file
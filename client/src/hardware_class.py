@@ -2,8 +2,16 @@
 from gpiozero import Button, RGBLED
 from colorzero import Color, Lightness, Saturation, Hue
 import asyncio
-import time
+from typing import Optional
+import numpy as np
 from env import ENV
+from led_engine import AnimationEngine, Animation, solid, blink, PRIORITY_IDLE, PRIORITY_MEASURING, PRIORITY_ERROR
+from buttons import ButtonInput, ButtonGesture, GestureDetector, GESTURE_PRESS, GESTURE_LONG, GESTURE_CHORD
+from dispatcher import DeviceEvent, EventType
+
+MEASURE = "measure"
+WHITE_REFERENCE = "white_reference"
+BACKGR_RADIATION = "backgr_radiation"
 
 class ButtonControl:
     """
@@ -13,12 +21,20 @@ class ButtonControl:
     - BTN_MEASURE: Button object for initiating measurement.
     - BTN_WHITE_REFERENCE: Button object for initiating white reference calibration.
     - BTN_BACKGR_RADIATION: Button object for initiating background radiation measurement.
+    - button_input: ButtonInput that turns the button edges into gestures on the event loop.
+
+    Gestures:
+    - measure pressed: measurement, of the armed reference if one is armed
+    - white reference / background radiation pressed: arm that reference
+    - white reference or background radiation held together with measure: measure that reference right away
+    - measure held for LONG_PRESS seconds: disarm the armed reference
 
     Methods:
-    - measure(): Print a message indicating measurement initiation.
-    - white_ref(): Print a message indicating white reference calibration initiation.
-    - backgr_rad(): Print a message indicating background radiation measurement initiation.
-    - monitor_for_press(): Asynchronous method to continuously monitor button presses and trigger corresponding actions.
+    - measure(): Post a measurement to the dispatcher.
+    - white_ref(): Arm the white reference calibration.
+    - backgr_rad(): Arm the background radiation measurement.
+    - on_gesture(): Runs the action of a gesture, on the event loop thread.
+    - monitor_for_press(): Asynchronous method that registers the button callbacks once.
 
     Usage Example:
     ```
@@ -27,17 +43,27 @@ class ButtonControl:
     ```
     """
 
+    DEBOUNCE = 0.03
+    LONG_PRESS = 1.5
+
     def __init__(self, event_manager) -> None:
-        self.BTN_MEASURE = Button(ENV.BTN_MEASURE, pull_up=True)
-        self.BTN_WHITE_REFERENCE = Button(ENV.BTN_WHITE_REFERENCE, pull_up=True)
-        self.BTN_BACKGR_RADIATION = Button(ENV.BTN_BACKGR_RADIATION, pull_up=True)
+        self.BTN_MEASURE = Button(ENV.BTN_MEASURE, pull_up=True, hold_time=self.LONG_PRESS)
+        self.BTN_WHITE_REFERENCE = Button(ENV.BTN_WHITE_REFERENCE, pull_up=True, hold_time=self.LONG_PRESS)
+        self.BTN_BACKGR_RADIATION = Button(ENV.BTN_BACKGR_RADIATION, pull_up=True, hold_time=self.LONG_PRESS)
         self.event_manager = event_manager
-        
+        self.button_input = ButtonInput(
+            {MEASURE: self.BTN_MEASURE, WHITE_REFERENCE: self.BTN_WHITE_REFERENCE, BACKGR_RADIATION: self.BTN_BACKGR_RADIATION},
+            self.on_gesture,
+            GestureDetector(debounce=self.DEBOUNCE, long_press=self.LONG_PRESS),
+        )
         pass
 
-    def measure(self):
+    def measure(self, origin: Optional[float] = None):
         print("MEASURE")
-        self.event_manager.measure_event.set()
+        if origin is None:
+            self.event_manager.dispatcher.post(DeviceEvent(EventType.MEASURE))
+        else:
+            self.event_manager.dispatcher.post(DeviceEvent(EventType.MEASURE, origin=origin))
 
     def white_ref(self):
         print("WHITEREF")
@@ -47,31 +73,52 @@ class ButtonControl:
         print("BACKGROUND RADIATION")
         self.event_manager.backgr_rad_event.set()
 
+    def disarm(self):
+        print("REFERENCE DISARMED")
+        self.event_manager.white_ref_event.clear()
+        self.event_manager.backgr_rad_event.clear()
+
+    def on_gesture(self, gesture: ButtonGesture):
+        if self.event_manager.in_progress:
+            return
+        buttons = gesture.buttons
+        if gesture.kind == GESTURE_PRESS:
+            if MEASURE in buttons:
+                self.measure(gesture.edge)
+            elif WHITE_REFERENCE in buttons:
+                self.white_ref()
+            else:
+                self.backgr_rad()
+        elif gesture.kind == GESTURE_LONG:
+            if MEASURE in buttons:
+                self.disarm()
+        elif gesture.kind == GESTURE_CHORD and MEASURE in buttons and len(buttons) == 2:
+            # The reference is armed on this thread before the dispatcher sees the measurement
+            if WHITE_REFERENCE in buttons:
+                self.event_manager.backgr_rad_event.clear()
+                self.white_ref()
+            else:
+                self.event_manager.white_ref_event.clear()
+                self.backgr_rad()
+            self.measure(gesture.edge)
+
     async def monitor_for_press(self):
-        def debounced_handler(btn):
-            while btn.is_pressed:
-                time.sleep(0.2) #debounce
-            if not self.event_manager.in_progress:
-                if btn == self.BTN_MEASURE:
-                    self.measure()
-                elif btn == self.BTN_WHITE_REFERENCE:
-                    self.white_ref()
-                else:
-                    self.backgr_rad()
-              
-        while True:
-            await asyncio.sleep(0.5)
-            self.BTN_MEASURE.when_pressed = debounced_handler
-            self.BTN_WHITE_REFERENCE.when_pressed = debounced_handler
-            self.BTN_BACKGR_RADIATION.when_pressed = debounced_handler
+        # gpiozero calls the callbacks from its own threads, the gestures are handed to this loop
+        self.button_input.start(asyncio.get_running_loop())
             
 class LedControl:
     """
     A class representing a control system for the 
     Common Anode RGB LED used in a measurement device.
 
+    The animations are computed into frame tables once, here, and played by an
+    AnimationEngine, so only one animation drives the LED at a time: the error blink
+    takes precedence over the measuring light, which takes precedence over the startup
+    animation.
+
     Attributes:
     - LED_RGB: (gpiozero.RGBLED) Object initiated using the environment variables for GPIO pins.
+    - engine: (AnimationEngine) Plays the animations, see `engine.jitter_ms()` for the frame timing.
 
     """
 
@@ -90,14 +137,18 @@ class LedControl:
             "#114709",
             "#0b2807",
         ]
+        self.engine = AnimationEngine(self.set_value)
+        self.startup = Animation("startup", self.gradient_frames(), 0.05, PRIORITY_IDLE)
+        self.measuring = solid("measuring", (Color(0,1,0) * Lightness(0.6)).rgb_bytes, PRIORITY_MEASURING)
+        self.error = blink("error", (Color(1,0,0) * Lightness(0.7) + Saturation(0.3)).rgb_bytes, 4, 0.65, PRIORITY_ERROR)
         pass
-    
-    async def startup_notification(self):
-        await self.gradient_hue()
-        print("Done startup...")
-        return
-        
-    async def gradient_hue(self):
+
+    def set_value(self, value: tuple) -> None:
+        self.LED_RGB.value = value
+
+    def gradient_frames(self) -> np.ndarray:
+        # The colour math of the startup animation, evaluated once into a frame table
+        frames = []
         j = 0.005
         i = 0
         l = 0.1
@@ -107,9 +158,8 @@ class LedControl:
             if l <= 0.80:
                 l += 0.005 
             current_color = self.gradient[i]
-            self.LED_RGB.color = Color(current_color) * Lightness(l) + Saturation(j)
+            frames.append((Color(current_color) * Lightness(l) + Saturation(j)).rgb_bytes)
             j += 0.005
-            await asyncio.sleep(0.05)
             if descending:
                 if i == 0:
                     descending = False
@@ -120,21 +170,24 @@ class LedControl:
                 i -= 1
             else:
                 i += 1
-        self.LED_RGB.color = Color(0, 0, 0)
+        return np.array(frames, dtype=np.uint8)
+    
+    async def startup_notification(self):
+        await self.gradient_hue()
+        print("Done startup...")
+        return
+        
+    async def gradient_hue(self):
+        if self.engine.play(self.startup):
+            await self.engine.wait()
         return
         
     async def on(self):
-        self.LED_RGB.color = Color(0,1,0) * Lightness(0.6)
+        self.engine.play(self.measuring)
         
     async def off(self):
-        self.LED_RGB.color = Color(0,0,0)
+        self.engine.stop(PRIORITY_MEASURING)
         
     async def blink_red(self):
-        i = 0
-        while i <= 3: 
-            self.LED_RGB.color = Color(1,0,0) * Lightness(0.7) + Saturation(0.3)
-            await asyncio.sleep(0.65)
-            self.LED_RGB.color = Color(0,0,0)
-            await asyncio.sleep(0.65)
-            i += 1
-        
\ No newline at end of file
+        if self.engine.play(self.error):
+            await self.engine.wait()
@@ -0,0 +1,167 @@
+import mmap
+import os
+import re
+import struct
+import time
+from typing import Iterator, Optional
+import numpy as np
+
+HISTORY_PATH = "../history.bin"
+LABELS = ["Polyester", "Cotton", "Wool"]
+TOP_K = 3
+SPECTRUM_POINTS = 512
+
+# magic, version, flags, capacity, records written since the file was created
+HEADER = struct.Struct("<4sHHII")
+MAGIC = b"NIRH"
+# 2: records with spectra also hold the burst variance
+VERSION = 2
+FLAG_SPECTRA = 1
+
+# "Cotton: 70%" as formatted by APIClient.decode_labels and BSDClient.decode_labels
+LABEL_PATTERN = re.compile(r"(\w+):\s*([\d.]+)%")
+
+def record_dtype(store_spectra: bool) -> np.dtype:
+    fields = [
+        ("time", "<u4"),
+        ("type", "S1"),
+        ("count", "u1"),
+        ("labels", "u1", (TOP_K,)),
+        ("percent", "u1", (TOP_K,)),
+    ]
+    if store_spectra:
+        fields.append(("spectrum", "<f4", (SPECTRUM_POINTS,)))
+        fields.append(("variance", "<f4", (SPECTRUM_POINTS,)))
+    return np.dtype(fields)
+
+def parse_labels(text: str) -> list[tuple[int, int]]:
+    """Returns the (label index, percent) pairs of a formatted result, best first, at most TOP_K."""
+    labels = []
+    for name, percent in LABEL_PATTERN.findall(text or ""):
+        if name in LABELS:
+            labels.append((LABELS.index(name), min(100, int(round(float(percent))))))
+    labels.sort(key=lambda label: label[1], reverse=True)
+    return labels[:TOP_K]
+
+class MeasurementHistory():
+    """
+    Fixed capacity ring buffer of the latest measurements, kept in a memory-mapped file.
+
+    Each record holds the time, the measurement type, the top TOP_K labels with their
+    percentages and, with `store_spectra`, the raw spectrum and for bursts its per
+    wavelength variance (NaN for a single scan). Records are a numpy
+    structured array mapped straight onto the file, so appending is one slot write and
+    the history survives restarts without a separate save step. A file written with
+    another capacity or layout is started over.
+
+    `encode()` packs a page of the history into a short string for the BLE reply:
+
+        <records held>|<offset of the next page, 0 if none>|<entry>;<entry>;...
+
+    Entries are newest first. The first entry carries the unix time, the following ones
+    the seconds elapsed since the next newer entry. After the time comes the type (w, b
+    or m) and for samples the labels as <label index>:<percent> separated by commas,
+    e.g. `3|0|1700000000m1:70,2:20,0:10;3600w;60b`.
+
+    Usage Example:
+    ```
+    history = MeasurementHistory()
+    history.append("m", parse_labels(server_response), spectrum)
+    reply = history.encode(max_bytes=271)
+    ```
+    """
+
+    def __init__(self, path: str = HISTORY_PATH, capacity: int = 64, store_spectra: bool = False) -> None:
+        self.path = path
+        self.capacity = capacity
+        self.store_spectra = store_spectra
+        self.dtype = record_dtype(store_spectra)
+        size = HEADER.size + capacity * self.dtype.itemsize
+        flags = FLAG_SPECTRA if store_spectra else 0
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            header = os.pread(fd, HEADER.size, 0)
+            valid = (len(header) == HEADER.size and os.fstat(fd).st_size == size
+                     and HEADER.unpack(header)[:4] == (MAGIC, VERSION, flags, capacity))
+            if not valid:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                os.pwrite(fd, HEADER.pack(MAGIC, VERSION, flags, capacity, 0), 0)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            # The mapping keeps its own reference to the file
+            os.close(fd)
+        self.records = np.frombuffer(self.map, dtype=self.dtype, count=capacity, offset=HEADER.size)
+        self.written = HEADER.unpack_from(self.map)[4]
+
+    def __len__(self) -> int:
+        return min(self.written, self.capacity)
+
+    def append(self, measure_type: str, labels: list[tuple[int, int]], spectrum=None,
+               timestamp: Optional[int] = None, variance=None) -> None:
+        record = self.records[self.written % self.capacity]
+        record["time"] = int(time.time()) if timestamp is None else timestamp
+        record["type"] = measure_type.encode()[:1]
+        record["count"] = len(labels)
+        record["labels"] = 0
+        record["percent"] = 0
+        for i, (label, percent) in enumerate(labels[:TOP_K]):
+            record["labels"][i] = label
+            record["percent"][i] = percent
+        if self.store_spectra:
+            if spectrum is None:
+                record["spectrum"] = np.nan
+            else:
+                record["spectrum"] = spectrum
+            record["variance"] = np.nan if variance is None else variance
+        # The counter is bumped after the slot is complete, a crash mid-write leaves the old count
+        self.written += 1
+        struct.pack_into("<I", self.map, HEADER.size - 4, self.written)
+        return None
+
+    def newest(self, offset: int = 0) -> Iterator[np.void]:
+        """Yields the held records newest first, skipping the `offset` newest."""
+        for i in range(offset, len(self)):
+            yield self.records[(self.written - 1 - i) % self.capacity]
+
+    def page(self, offset: int = 0, limit: int = 10) -> list[dict]:
+        entries = []
+        for record in self.newest(offset):
+            if len(entries) == limit:
+                break
+            entries.append({
+                "time": int(record["time"]),
+                "type": record["type"].decode(),
+                "labels": [(LABELS[record["labels"][i]], int(record["percent"][i])) for i in range(record["count"])],
+            })
+        return entries
+
+    def encode(self, max_bytes: int, offset: int = 0) -> str:
+        """Packs as many records as fit in `max_bytes`, newest first from `offset`, see the class docstring."""
+        held = len(self)
+        entries = []
+        # Room for both numbers of the prefix at their longest
+        used = 2 * len(str(held)) + 2
+        newer_time = None
+        next_offset = offset
+        for record in self.newest(offset):
+            timestamp = int(record["time"])
+            stamp = timestamp if newer_time is None else max(0, newer_time - timestamp)
+            labels = ",".join(f"{record['labels'][i]}:{record['percent'][i]}" for i in range(record["count"]))
+            entry = f"{stamp}{record['type'].decode()}{labels}"
+            if used + len(entry) + (1 if entries else 0) > max_bytes:
+                break
+            used += len(entry) + (1 if entries else 0)
+            entries.append(entry)
+            newer_time = timestamp
+            next_offset += 1
+        more = next_offset if next_offset < held else 0
+        return f"{held}|{more}|" + ";".join(entries)
+
+    def close(self) -> None:
+        self.map.flush()
+        # The array view has to go before the mapping can be closed
+        self.records = None
+        self.map.close()
+        return None
@@ -0,0 +1,79 @@
+import asyncio
+import numpy as np
+
+class MicroBatcher():
+    """
+    Collects concurrent inference requests and runs them through the model as one batch.
+
+    A batch is closed when it reaches `max_batch` requests or `max_delay` seconds after
+    its first request arrived, whichever comes first. Batches are padded up to the next
+    power of two so the model only needs a resized interpreter for a handful of shapes.
+    Each output row is routed back to the request that sent the matching input row.
+
+    NOTE: Runs in the inference server on Python 3.7, keep it compatible.
+
+    Usage Example:
+    ```
+    batcher = MicroBatcher(model, max_batch=8, max_delay=0.003)
+    loop.create_task(batcher.run())
+    row = await batcher.submit(spectrum)
+    ```
+    """
+
+    def __init__(self, model, max_batch: int = 8, max_delay: float = 0.003) -> None:
+        self.model = model
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = None
+        self.batches = 0
+        self.requests = 0
+
+    async def submit(self, spectrum: np.ndarray) -> np.ndarray:
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((spectrum, future))
+        return await future
+
+    def padded_size(self, count: int) -> int:
+        size = 1
+        while size < count:
+            size *= 2
+        return min(size, self.max_batch)
+
+    async def collect(self) -> list:
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_delay
+        while len(batch) < self.max_batch:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self) -> None:
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        while True:
+            batch = await self.collect()
+            try:
+                slot = self.model.batch_slot(self.padded_size(len(batch)))
+                # Rows past the batch keep stale data, their outputs are discarded
+                slot.set_input(spectrum for spectrum, _ in batch)
+                outputs = slot.run()
+                for row, (_, future) in enumerate(batch):
+                    if not future.done():
+                        future.set_result(outputs[row].copy())
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            self.batches += 1
+            self.requests += len(batch)
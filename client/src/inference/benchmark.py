@@ -0,0 +1,50 @@
+"""
+Benchmarks for the inference server, run from the tfenv virtual environment:
+
+    python3.7 benchmark.py [model path]
+
+Reports time per inference and what each call leaves allocated, for the fast path
+and for the set_tensor/get_tensor path the server used before.
+"""
+import sys
+import time
+import tracemalloc
+import numpy as np
+from loaded_model import TFLiteModel
+
+def measure(fn, runs: int):
+    fn()
+    start = time.perf_counter()
+    for _ in range(runs):
+        fn()
+    per_call = (time.perf_counter() - start) / runs
+
+    # Peak traced memory above the starting point is what a single call allocates while running
+    tracemalloc.start()
+    base, _ = tracemalloc.get_traced_memory()
+    blocks = sys.getallocatedblocks()
+    for _ in range(runs):
+        fn()
+    blocks = sys.getallocatedblocks() - blocks
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return per_call, peak - base, blocks
+
+def bench_predict(model: TFLiteModel, runs: int = 2000) -> None:
+    spectrum = np.random.default_rng(0).random(model.features).astype(np.float32)
+    interpreter = model.interpreter
+
+    def legacy():
+        features = np.expand_dims(np.array(spectrum, dtype=np.float32), axis=0)
+        interpreter.set_tensor(model.input_index, features)
+        interpreter.invoke()
+        return interpreter.get_tensor(model.output_index)
+
+    for name, fn in (("legacy", legacy), ("fast path", lambda: model.predict(spectrum))):
+        per_call, peak, blocks = measure(fn, runs)
+        print(f"predict {name:10} {per_call * 1e6:8.1f} us/call, peak {peak:6d} B allocated, {blocks:+d} blocks left after {runs} calls")
+    return None
+
+if __name__ == "__main__":
+    model_path = sys.argv[1] if len(sys.argv) > 1 else "model.tflite"
+    bench_predict(TFLiteModel(model_path))
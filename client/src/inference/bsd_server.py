@@ -1,45 +1,65 @@
 import os
-import socket
-import json
 import asyncio
 from loaded_model import TFLiteModel
+from batching import MicroBatcher
+from ipc_protocol import MSG_SPECTRUM, MSG_PREDICTION, MSG_ERROR, MSG_INFO, FrameError
+from ipc_protocol import read_frame, write_frame, write_array, decode_array
 
 class BSDServer():
     def __init__(self) -> None:
         self.model = TFLiteModel("model.tflite")
+        self.batcher = MicroBatcher(self.model, max_batch=8, max_delay=0.003)
         self.SOCK_POST = '/tmp/model-ipc-post.socket'
-        if not os.path.exists(self.SOCK_POST):
-            print(f"WARNING: File {self.SOCK_POST} doesn't exist")
-
-        self.socket_post = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        
         print(f"Model IPC Socket starting at '{self.SOCK_POST}'")
+        print(f"Model version {self.model.version}")
         print(f"Model parameters:\n{self.model.input_details}\n{self.model.output_details}\n-----")
 
+    async def respond(self, writer: asyncio.StreamWriter, drain_lock: asyncio.Lock, request_id: int, payload: bytes):
+        try:
+            result = await self.batcher.submit(decode_array(payload))
+            write_array(writer, MSG_PREDICTION, request_id, result)
+        except Exception as e:
+            print("Prediction failed: ", e)
+            write_frame(writer, MSG_ERROR, request_id, str(e).encode())
+        # Only one task may wait on drain() of a writer at a time
+        async with drain_lock:
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        print("Client connected")
+        loop = asyncio.get_running_loop()
+        drain_lock = asyncio.Lock()
+        try:
+            while True:
+                msg_type, request_id, payload = await read_frame(reader)
+                if msg_type == MSG_INFO:
+                    write_frame(writer, MSG_INFO, request_id, self.model.version.encode())
+                    continue
+                if msg_type != MSG_SPECTRUM:
+                    write_frame(writer, MSG_ERROR, request_id, f"Unknown message type {msg_type}".encode())
+                    continue
+                # Requests are answered as they complete, so one client's requests can share a batch
+                loop.create_task(self.respond(writer, drain_lock, request_id, payload))
+        except asyncio.IncompleteReadError:
+            print("Client disconnected")
+        except (FrameError, ConnectionError) as e:
+            print("Closing client connection: ", e)
+        finally:
+            writer.close()
+
     async def main_loop(self):
-        self.socket_post.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.socket_post.bind(self.SOCK_POST)
-        self.socket_post.listen(0)
+        # A socket file left behind by a previous run would make the bind fail
+        if os.path.exists(self.SOCK_POST):
+            os.unlink(self.SOCK_POST)
+        asyncio.get_running_loop().create_task(self.batcher.run())
+        server = await asyncio.start_unix_server(self.handle_client, path=self.SOCK_POST)
         print("succesfully bound to socket")
-        while True:
-            await asyncio.sleep(0.6)
-            print("Waiting client...")
-            conn, addr = self.socket_post.accept()
-            print("Client connected")
-            while True:
-                await asyncio.sleep(1)
-                print("Waiting for data")
-                received_data = conn.recv(16384)
-                received_list = json.loads(received_data.decode())
-                print(f"Received data: {received_list}")
-                result = self.model.predict(received_list)
-                print(result)
-                print(type(result))
-                serialized_data = json.dumps(result.tolist())
-                print(serialized_data)
-                print("Sending data:")
-                conn.sendall(serialized_data.encode())
+        async with server:
+            await server.serve_forever()
 
 if __name__ == "__main__":
     app = BSDServer()
-    asyncio.run(app.main_loop())
\ No newline at end of file
+    asyncio.run(app.main_loop())
@@ -0,0 +1,64 @@
+"""
+Framing for the model IPC socket, shared by BSDServer and BSDClient.
+
+Every message is a fixed 12 byte little-endian header followed by the payload:
+
+    uint8   message type (MSG_*)
+    3 bytes padding
+    uint32  request id, echoed back in the reply so several requests can be in flight
+    uint32  payload length in bytes
+
+Spectra and predictions are sent as raw little-endian float32 values, errors as utf-8 text.
+An empty MSG_INFO request is answered with MSG_INFO carrying the model version as utf-8 text.
+
+NOTE: This module is imported by the inference server running on Python 3.7,
+keep it compatible.
+"""
+import asyncio
+import struct
+from typing import Tuple
+import numpy as np
+
+HEADER = struct.Struct("<BxxxII")
+MSG_SPECTRUM = 1
+MSG_PREDICTION = 2
+MSG_ERROR = 3
+MSG_INFO = 4
+# Upper bound for a single payload, anything larger is treated as a corrupt stream
+MAX_PAYLOAD = 1 << 20
+
+class FrameError(Exception):
+    """Raised when the peer sends a frame that can not be valid."""
+    pass
+
+def write_frame(writer: asyncio.StreamWriter, msg_type: int, request_id: int, payload: bytes) -> None:
+    writer.write(HEADER.pack(msg_type, request_id, len(payload)))
+    writer.write(payload)
+    return None
+
+def write_array(writer: asyncio.StreamWriter, msg_type: int, request_id: int, values) -> None:
+    """Writes `values` as float32 without an intermediate bytes object when it already is float32."""
+    array = np.ascontiguousarray(values, dtype='<f4')
+    writer.write(HEADER.pack(msg_type, request_id, array.nbytes))
+    writer.write(memoryview(array).cast('B'))
+    return None
+
+async def read_frame(reader: asyncio.StreamReader) -> Tuple[int, int, bytes]:
+    """
+    Reads one frame and returns (message type, request id, payload).
+
+    Raises:
+        asyncio.IncompleteReadError: If the connection closes mid-frame.
+        FrameError: If the header announces a payload larger than MAX_PAYLOAD.
+    """
+    header = await reader.readexactly(HEADER.size)
+    msg_type, request_id, length = HEADER.unpack(header)
+    if length > MAX_PAYLOAD:
+        raise FrameError("Payload of {} bytes exceeds the limit of {}".format(length, MAX_PAYLOAD))
+    payload = await reader.readexactly(length)
+    return msg_type, request_id, payload
+
+def decode_array(payload: bytes) -> np.ndarray:
+    if len(payload) % 4:
+        raise FrameError("Payload of {} bytes is not a float32 array".format(len(payload)))
+    return np.frombuffer(payload, dtype='<f4')
@@ -1,18 +1,126 @@
+import hashlib
 import numpy as np
 import tflite_runtime.interpreter as tflite
 
+def quantization(details: dict):
+    """Returns (scale, zero point) of an int8/uint8 tensor, or None for a float tensor."""
+    scale, zero_point = details["quantization"]
+    if details["dtype"] in (np.int8, np.uint8) and scale != 0:
+        return float(scale), int(zero_point)
+    return None
+
+class InterpreterSlot:
+    """
+    An interpreter allocated for one batch size, with raw tensor accessors and a reused output buffer.
+
+    The accessors returned by `interpreter.tensor()` give numpy views into the interpreter's
+    own memory. TFLite refuses to invoke while such a view is alive, so views are only
+    taken for the duration of a copy and never returned to callers.
+
+    For integer quantized models the float32 input is quantized with the input tensor's
+    scale and zero point, and the output is dequantized, so callers always see float32.
+    """
+    __slots__ = ("interpreter", "input", "output", "result",
+                 "input_quant", "output_quant", "staging", "input_limits")
+
+    def __init__(self, interpreter, input_details: dict, output_details: dict) -> None:
+        self.interpreter = interpreter
+        self.input = interpreter.tensor(input_details["index"])
+        self.output = interpreter.tensor(output_details["index"])
+        self.input_quant = quantization(input_details)
+        self.output_quant = quantization(output_details)
+        self.result = np.empty(self.output().shape, dtype=np.float32)
+        self.staging = None
+        self.input_limits = None
+        if self.input_quant is not None:
+            info = np.iinfo(input_details["dtype"])
+            self.staging = np.empty(self.input().shape, dtype=np.float32)
+            self.input_limits = (info.min, info.max)
+
+    def set_input(self, rows) -> None:
+        """Writes the float32 rows (a 2-D array or an iterable of spectra) into the input tensor."""
+        if self.input_quant is None:
+            target = self.input()
+            for row, values in enumerate(rows):
+                target[row] = values
+            return None
+        staging = self.staging
+        for row, values in enumerate(rows):
+            staging[row] = values
+        # q = round(x / scale + zero_point), clipped to the integer range
+        scale, zero_point = self.input_quant
+        np.multiply(staging, 1.0 / scale, out=staging)
+        np.add(staging, zero_point, out=staging)
+        np.rint(staging, out=staging)
+        np.clip(staging, self.input_limits[0], self.input_limits[1], out=staging)
+        np.copyto(self.input(), staging, casting="unsafe")
+        return None
+
+    def run(self) -> np.ndarray:
+        self.interpreter.invoke()
+        if self.output_quant is None:
+            np.copyto(self.result, self.output())
+        else:
+            # x = (q - zero_point) * scale
+            scale, zero_point = self.output_quant
+            np.subtract(self.output(), zero_point, out=self.result, dtype=np.float32)
+            np.multiply(self.result, scale, out=self.result)
+        return self.result
+
 class TFLiteModel:
-    def __init__(self, model_path: str):
-        self.interpreter = tflite.Interpreter(model_path)
+    def __init__(self, model_path: str, num_threads: int = 1, warmup: int = 2):
+        self.model_path = model_path
+        self.num_threads = num_threads
+        self.warmup = warmup
+        with open(model_path, "rb") as model_file:
+            # Identifies the loaded weights, clients key cached results on it
+            self.version = hashlib.sha256(model_file.read()).hexdigest()[:16]
+        self.interpreter = tflite.Interpreter(model_path, num_threads=num_threads)
         self.interpreter.allocate_tensors()
 
         self.input_details = self.interpreter.get_input_details()
         self.output_details = self.interpreter.get_output_details()
+        self.input_index = self.input_details[0]["index"]
+        self.output_index = self.output_details[0]["index"]
+        self.features = int(self.input_details[0]["shape"][-1])
+        # Interpreters resized for a batch size, keyed by that batch size
+        self.slots = {1: self.warm_up(InterpreterSlot(self.interpreter, self.input_details[0], self.output_details[0]))}
 
-    def predict(self, data: list):
-        features = np.expand_dims(np.array(data, dtype=np.float32), axis=0)
-        for i in features:
-            print(type(i))
-        self.interpreter.set_tensor(self.input_details[0]["index"], features)
-        self.interpreter.invoke()
-        return self.interpreter.get_tensor(self.output_details[0]["index"])
+    def warm_up(self, slot: InterpreterSlot) -> InterpreterSlot:
+        # The first invocations pay for lazy kernel preparation, do it before serving requests
+        slot.set_input(np.zeros(slot.input().shape, dtype=np.float32))
+        for _ in range(self.warmup):
+            slot.run()
+        return slot
+
+    def predict(self, data) -> np.ndarray:
+        """
+        Runs one spectrum through the model and returns the 1 x outputs result.
+
+        The input is written straight into the interpreter's input tensor and the result
+        is a buffer reused by the next call, copy it if it has to be kept.
+        """
+        slot = self.slots[1]
+        slot.set_input((data,))
+        return slot.run()
+
+    def batch_slot(self, batch_size: int) -> InterpreterSlot:
+        """Returns an interpreter whose input is resized to batch_size x features, built once per size."""
+        slot = self.slots.get(batch_size)
+        if slot is None:
+            interpreter = tflite.Interpreter(self.model_path, num_threads=self.num_threads)
+            interpreter.resize_tensor_input(self.input_index, [batch_size, self.features])
+            interpreter.allocate_tensors()
+            slot = self.warm_up(InterpreterSlot(interpreter, interpreter.get_input_details()[0], interpreter.get_output_details()[0]))
+            self.slots[batch_size] = slot
+        return slot
+
+    def predict_batch(self, features: np.ndarray) -> np.ndarray:
+        """
+        Runs one invoke for a batch_size x features array and returns one output row per input row.
+
+        The result is a buffer reused by the next batch of the same size.
+        """
+        slot = self.batch_slot(features.shape[0])
+        slot.set_input(features)
+        return slot.run()
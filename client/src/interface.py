@@ -1,75 +1,230 @@
 # src/interface.py
+import asyncio
 import json
-import requests
+import time
+import aiohttp
+from collections import deque
 from datetime import datetime, timezone
 from typing import Optional
 from env import ENV
 from hmac_auth import HmacAuth
+from spectrum_codec import (JSON_MEDIA_TYPE, SPECTRUM_MEDIA_TYPE, encode_json,
+                            encode_spectrum, deflate, parse_media_types)
+
+# Seconds between registration attempts, doubled after each failure up to the max
+NOTIFY_RETRY_DELAY = 2.0
+NOTIFY_RETRY_MAX_DELAY = 60.0
+
+class APIError(Exception):
+    """The API answered with a status other than 200."""
+    def __init__(self, status: int) -> None:
+        super().__init__(f"HTTP error: {status}")
+        self.status = status
+
 class APIClient:
+    """
+    HTTP client for the measurement API.
+
+    All requests go through one aiohttp session, so the TCP and TLS connection to the
+    API is kept alive and reused between measurements instead of being set up for every
+    upload. Nothing here blocks the event loop.
+
+    The session can only be created on a running loop, so registering the device with
+    the API happens in `start()`, which retries in the background until it succeeds.
+    `status_active` stays False until then and measurements use local inference.
+    A failed upload (no connection, timeout or 5xx) takes the client offline again and
+    restarts registration, `online` is set while the client is registered.
+
+    The latency of the recent requests is kept per endpoint, see `latency_ms()`.
 
-    def __init__(self, event_manager):
+    Measurements are sent as JSON unless the API lists `SPECTRUM_MEDIA_TYPE` in an
+    `Accept-Post` response header, then they are sent in the binary format from
+    `spectrum_codec` (float32, or float16 with UPLOAD_FORMAT=float16), deflate
+    compressed when the API lists `deflate` in `Accept-Encoding` and it saves space.
+    UPLOAD_FORMAT=json keeps the JSON body regardless. A 415 reply switches back to JSON.
+
+    Usage Example:
+    ```
+    api_client = APIClient(event_manager)
+    api_client.start()
+    await api_client.send_data_to_api(packet)
+    ```
+    """
+
+    def __init__(self, event_manager, latency_samples: int = 20):
         self.url = str(ENV.API_URL)
-        self.headers = {"Content-Type": "application/json"}
+        self.headers = {"Content-Type": JSON_MEDIA_TYPE}
         self.__auth_method = HmacAuth()
-        self.status_active = self.__notify_server()
+        self.status_active = False
         self.event_manager = event_manager
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.registration: Optional[asyncio.Task] = None
+        self.online: Optional[asyncio.Event] = None
+        self.latency: dict[str, deque] = {
+            "send": deque(maxlen=latency_samples),
+            "notify": deque(maxlen=latency_samples),
+        }
+        self.failures: dict[str, int] = {"send": 0, "notify": 0}
+        self.upload_format = ENV.UPLOAD_FORMAT
+        # Learned from the Accept-Post / Accept-Encoding headers of the API's replies
+        self.accepts_spectrum = False
+        self.accepts_deflate = False
+        # Reported by the API in an X-Model-Version reply header, results are cached per version
+        self.model_version = "api"
+
+    def start(self) -> None:
+        """Starts registering the device in the background, call from the event loop."""
+        if self.online is None:
+            self.online = asyncio.Event()
+        if self.registration is None or self.registration.done():
+            self.registration = asyncio.get_running_loop().create_task(self.__register())
+        return None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=4, keepalive_timeout=60, ttl_dns_cache=300)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
 
-    async def __send_data(self, data: dict) -> Optional[str]:
+    async def close(self) -> None:
+        if self.registration is not None:
+            self.registration.cancel()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        return None
+
+    def latency_ms(self, endpoint: str) -> Optional[float]:
+        """Average latency of the recent successful requests to `endpoint` ("send" or "notify"), in milliseconds."""
+        samples = self.latency[endpoint]
+        if not samples:
+            return None
+        return sum(samples) / len(samples) * 1000
+
+    def negotiate(self, headers) -> None:
+        accept_post = headers.get("Accept-Post")
+        if accept_post is not None:
+            self.accepts_spectrum = SPECTRUM_MEDIA_TYPE in parse_media_types(accept_post)
+        accept_encoding = headers.get("Accept-Encoding")
+        if accept_encoding is not None:
+            self.accepts_deflate = "deflate" in parse_media_types(accept_encoding)
+        model_version = headers.get("X-Model-Version")
+        if model_version is not None:
+            self.model_version = f"api:{model_version}"
+        return None
+
+    def encode_packet(self, packet: dict) -> tuple[bytes, dict]:
+        """Returns the request body and headers for a measurement packet, in the best format the API accepts."""
+        if self.upload_format == "json" or not self.accepts_spectrum:
+            return encode_json(packet), self.headers
+        body = encode_spectrum(packet, "float16" if self.upload_format == "float16" else "float32")
+        headers = {"Content-Type": SPECTRUM_MEDIA_TYPE, "Accept": JSON_MEDIA_TYPE}
+        if self.accepts_deflate:
+            compressed = deflate(body)
+            if len(compressed) < len(body):
+                body = compressed
+                headers["Content-Encoding"] = "deflate"
+        return body, headers
+
+    async def __post(self, endpoint: str, url: str, payload: bytes, headers: dict, timeout: aiohttp.ClientTimeout) -> str:
+        start = time.monotonic()
+        try:
+            async with self.get_session().post(url, data=payload, headers=headers, timeout=timeout) as response:
+                text = await response.text()
+                self.negotiate(response.headers)
+                if response.status == 415 and headers.get("Content-Type") != JSON_MEDIA_TYPE:
+                    self.accepts_spectrum = False
+                if response.status != 200:
+                    raise APIError(response.status)
+        except Exception:
+            self.failures[endpoint] += 1
+            raise
+        elapsed = time.monotonic() - start
+        self.latency[endpoint].append(elapsed)
+        print(f"API {endpoint} took {elapsed * 1000:.1f} ms")
+        return text
+
+    def set_offline(self) -> None:
+        if self.status_active:
+            print("API unreachable, registering again")
+            self.status_active = False
+            self.online.clear()
+            self.start()
+        return None
+
+    async def upload(self, data: dict) -> str:
+        """
+        Sends one measurement packet and returns the API's reply, raises if it was not accepted.
+
+        Anything but a 4xx reply means the API is unreachable and takes the client offline.
+        """
+        payload, headers = self.encode_packet(data)
+        try:
+            try:
+                return await self.__post("send", self.url, payload, headers, aiohttp.ClientTimeout(total=10))
+            except APIError:
+                if headers is self.headers or self.accepts_spectrum:
+                    raise
+                # The API stopped accepting the binary format, send this one as JSON
+                return await self.__post("send", self.url, encode_json(data), self.headers, aiohttp.ClientTimeout(total=10))
+        except APIError as e:
+            if e.status >= 500:
+                self.set_offline()
+            raise
+        except Exception:
+            self.set_offline()
+            raise
+
+    async def send_data_to_api(self, data: dict) -> bool:
+        """Uploads a measurement, and for a sample also sets the decoded labels as the server response. Returns True if the API accepted it."""
+        if not data or not self.status_active:
+            return False
         print(f"Sending data to {self.url}")
-        result = ""
-        if (self.status_active):
-            payload = json.dumps(data)
+        try:
+            response = await self.upload(data)
+        except Exception as e:
+            print(f"Error sending data to API: {e}")
+            return False
+        print("API Response: ", response)
+        if data.get("type") == "m":
             try:
-                response = requests.post(self.url, payload, headers=self.headers, timeout=10)
-                if response.status_code == 200:
-                    result = response.text
-                else:
-                    result = "HTTP Error"
-                    raise Exception(f"HTTP error: {response.status_code}")
+                parsed_data = json.loads(response)
+                decoded_response = self.decode_labels(parsed_data)
+                self.event_manager.server_response = decoded_response
             except Exception as e:
-                result = "HTTP Timeout"
-                print(f"Error sending data to API: {e}")
-        return result
-
-    async def send_data_to_api(self, data: dict) -> None:
-        if data:
-            # Send the measurement values to API
-            response = await self.__send_data(data)
-            if response:
-                print("API Response: ", response)
-                if data.get("type") == "m":
-                    try:
-                        parsed_data = json.loads(response)
-                        decoded_response = self.decode_labels(parsed_data)
-                        self.event_manager.server_response = decoded_response
-                    except Exception as e:
-                        print(f"Error parsing API response: {e}")
-                        self.event_manager.server_response = response
-        return None
+                print(f"Error parsing API response: {e}")
+                self.event_manager.server_response = response
+        return True
 
-    def __notify_server(self) -> bool:
+    async def __notify_server(self) -> bool:
         success = False
-        time = int(datetime.now(tz=timezone.utc).timestamp())
-        hmac_headers = self.__auth_method.ask_for_headers(str(time))
+        timestamp = int(datetime.now(tz=timezone.utc).timestamp())
+        hmac_headers = self.__auth_method.ask_for_headers(str(timestamp))
         data = {
                 'id': int(str(ENV.DEVICE_ID)),
-                'time': time,
+                'time': timestamp,
             }
         payload = json.dumps(data)
         try:
-            response = requests.post(self.url + "/notify", payload, headers=hmac_headers, timeout=(5, 10))
-            if response.status_code == 200:
-                success = True
-                print(f"Succesfully initiated server object of Device ID:{str(ENV.DEVICE_ID)}")
-            else:
-                success = False
-                raise Exception(f"HTTP error: {response.status_code}")
+            await self.__post("notify", self.url + "/notify", payload, hmac_headers, aiohttp.ClientTimeout(total=15, sock_connect=5))
+            success = True
+            print(f"Succesfully initiated server object of Device ID:{str(ENV.DEVICE_ID)}")
         except Exception as e:
             print(f"Error sending data to API: {e}")
             success = False
-        print(f"Finished initializing APIClient, with status: {'Success' if success else 'Failed'}")
         return success
 
+    async def __register(self) -> None:
+        delay = NOTIFY_RETRY_DELAY
+        while not await self.__notify_server():
+            print(f"Retrying API registration in {delay:.0f} s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, NOTIFY_RETRY_MAX_DELAY)
+        self.status_active = True
+        self.online.set()
+        print("Finished initializing APIClient, with status: Success")
+        return None
+
     def decode_labels(self, data) -> str:
         if not isinstance(data, dict) or "outputs" not in data:
             return "Invalid data format"
@@ -92,4 +247,101 @@ class APIClient:
 
         except Exception as e:
             print(f"Error decoding labels: {e}")
-            return "Unknown"
\ No newline at end of file
+            return "Unknown"
+
+async def main():
+    """
+    Test harness against a local stub of the API, run from src with `python3 interface.py`.
+
+    The stub answers registration after one 503, advertises the binary upload format,
+    later rejects it with 415 and fails one upload with a 500. Checks that the client
+    registers with backoff, falls back to JSON, goes offline and registers again, and
+    keeps using one connection while it is up.
+    """
+    import socket
+    from aiohttp import web
+    from spectrum_codec import decode_spectrum
+    import numpy as np
+
+    class EventManagerStub:
+        server_response = ""
+
+    advertise = {"Accept-Post": f"{JSON_MEDIA_TYPE}, {SPECTRUM_MEDIA_TYPE}", "Accept-Encoding": "deflate", "X-Model-Version": "7"}
+    stub = {"notify_calls": 0, "binary": True, "fail_next": False, "peers": set(), "bodies": []}
+
+    async def notify(request: web.Request) -> web.Response:
+        assert "X-Hmac-Sig" in request.headers
+        stub["notify_calls"] += 1
+        stub["peers"].add(request.transport.get_extra_info("peername"))
+        if stub["notify_calls"] == 1:
+            return web.Response(status=503)
+        return web.Response(text="ok", headers=advertise)
+
+    async def send(request: web.Request) -> web.Response:
+        stub["peers"].add(request.transport.get_extra_info("peername"))
+        if stub["fail_next"]:
+            stub["fail_next"] = False
+            return web.Response(status=500)
+        content_type = request.headers["Content-Type"]
+        if content_type == SPECTRUM_MEDIA_TYPE and not stub["binary"]:
+            return web.Response(status=415)
+        # aiohttp has already inflated a deflate encoded body
+        body = await request.read()
+        data = json.loads(body)["data"] if content_type == JSON_MEDIA_TYPE else decode_spectrum(body)["data"]
+        assert len(data) == 512
+        stub["bodies"].append(content_type)
+        return web.json_response({"outputs": [[0.1, 0.7, 0.2]]}, headers=advertise if stub["binary"] else {})
+
+    app = web.Application()
+    app.router.add_post("/notify", notify)
+    app.router.add_post("/", send)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    await web.SockSite(runner, sock).start()
+
+    ENV.DEVICE_ID = ENV.DEVICE_ID or "1"
+    ENV.SHARED_KEY = ENV.SHARED_KEY or "stub"
+    event_manager = EventManagerStub()
+    client = APIClient(event_manager)
+    client.url = "http://%s:%d" % sock.getsockname()
+    client.upload_format = "auto"
+    packet = {"data": np.linspace(0, 1, 512, dtype=np.float32), "time": 1700000000, "id": 1, "type": "m"}
+    try:
+        # Registration: one 503, then accepted after NOTIFY_RETRY_DELAY
+        client.start()
+        await asyncio.wait_for(client.online.wait(), NOTIFY_RETRY_DELAY + 5)
+        assert client.status_active and stub["notify_calls"] == 2 and client.failures["notify"] == 1
+        assert client.accepts_spectrum and client.model_version == "api:7"
+
+        # Keep-alive: every upload reuses the registration's connection
+        for _ in range(5):
+            assert await client.send_data_to_api(packet)
+        assert stub["bodies"] == [SPECTRUM_MEDIA_TYPE] * 5, stub["bodies"]
+        assert len(stub["peers"]) == 1, stub["peers"]
+        assert event_manager.server_response.startswith("Cotton: 70%")
+
+        # 415: the same upload is repeated as JSON, later ones stay JSON
+        stub["binary"] = False
+        assert await client.send_data_to_api(packet)
+        assert await client.send_data_to_api(packet)
+        assert stub["bodies"][-2:] == [JSON_MEDIA_TYPE] * 2 and not client.accepts_spectrum
+
+        # 5xx: the client goes offline and registers again right away
+        stub["fail_next"] = True
+        assert not await client.send_data_to_api(packet)
+        assert not client.status_active
+        await asyncio.wait_for(client.online.wait(), 5)
+        assert client.status_active and stub["notify_calls"] == 3
+        assert await client.send_data_to_api(packet)
+
+        print(f"Registered after {stub['notify_calls'] - 1} attempts, {len(stub['bodies'])} uploads over "
+              f"{len(stub['peers'])} connection(s), send {client.latency_ms('send'):.1f} ms, failures {client.failures}")
+    finally:
+        await client.close()
+        await runner.cleanup()
+    return
+
+if __name__ == "__main__":
+    asyncio.run(main())
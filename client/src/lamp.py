@@ -0,0 +1,143 @@
+import asyncio
+import time
+from typing import Optional
+from command_engine import CommandEngine
+
+LAMP_OFF = "off"
+LAMP_WARMING = "warming"
+LAMP_ON = "on"
+
+# Used when the sensor does not answer `Lt`
+DEFAULT_WARM_UP = 0.5
+
+class LampController():
+    """
+    Keeps track of the sensor lamp, so consecutive scans share one warm lamp.
+
+    `acquire()` switches the lamp on (`LI100`) if it is off and waits until it has been
+    on for the warm-up time, which is read from the sensor (`Lt`, in milliseconds) the
+    first time the lamp is needed. `release()` leaves the lamp on for `idle_off`
+    seconds, a scan within that window starts right away, after it the lamp is switched
+    off (`LI0`). With `idle_off` 0 the lamp goes off after every scan, as it always did.
+
+    Dark measurements need the lamp off: `off()` switches it off immediately and reports
+    whether the sensor confirmed it.
+
+    The switch-on count, the time the lamp was on and how many scans found it warm
+    already are kept, see `stats()`.
+
+    Usage Example:
+    ```
+    lamp = LampController(serial_device.commands, idle_off=10)
+    await lamp.acquire()
+    ... scan ...
+    lamp.release()
+    ```
+    """
+
+    def __init__(self, commands: CommandEngine, idle_off: float = 10.0, timeout: float = 2.0) -> None:
+        self.commands = commands
+        self.idle_off = idle_off
+        self.timeout = timeout
+        self.warm_up: Optional[float] = None
+        self.state = LAMP_OFF
+        self.on_since = 0.0
+        self.on_time = 0.0
+        self.switch_ons = 0
+        self.warm_reuses = 0
+        self.users = 0
+        self.released_at = 0.0
+        self.lock: Optional[asyncio.Lock] = None
+        self.off_timer: Optional[asyncio.TimerHandle] = None
+
+    def get_lock(self) -> asyncio.Lock:
+        # Created on first use, inside the loop that drives the sensor
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        return self.lock
+
+    async def read_warm_up(self) -> float:
+        if self.warm_up is None:
+            try:
+                reply = await self.commands.query("Light Source Warm-Up Time", timeout=self.timeout)
+                warm_up = reply["Light Source Warm-Up Time"]
+            except Exception as e:
+                print("Failed to read lamp warm-up time: ", e)
+                warm_up = None
+            self.warm_up = DEFAULT_WARM_UP if warm_up is None else warm_up / 1000
+            print(f"Lamp warm-up time {self.warm_up:.3f} s")
+        return self.warm_up
+
+    async def acquire(self) -> None:
+        """Switches the lamp on if needed and returns once it is warm."""
+        self.cancel_off_timer()
+        async with self.get_lock():
+            self.users += 1
+            if self.state == LAMP_OFF:
+                warm_up = await self.read_warm_up()
+                try:
+                    await self.commands.transport.request(self.commands.CMDS["Light Source Power Level 100"], timeout=self.timeout)
+                except Exception:
+                    self.users -= 1
+                    raise
+                print("LAMP ON!")
+                self.state = LAMP_WARMING
+                self.on_since = time.monotonic()
+                self.switch_ons += 1
+            else:
+                warm_up = self.warm_up or 0.0
+                self.warm_reuses += 1
+            remaining = self.on_since + warm_up - time.monotonic()
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+            self.state = LAMP_ON
+        return None
+
+    def release(self) -> None:
+        """Ends a scan, the lamp goes off once nothing acquired it for `idle_off` seconds."""
+        self.users = max(0, self.users - 1)
+        self.released_at = time.monotonic()
+        if self.users == 0 and self.state != LAMP_OFF:
+            self.cancel_off_timer()
+            loop = asyncio.get_running_loop()
+            self.off_timer = loop.call_later(self.idle_off, lambda: loop.create_task(self.off(idle_only=True)))
+        return None
+
+    def cancel_off_timer(self) -> None:
+        if self.off_timer is not None:
+            self.off_timer.cancel()
+            self.off_timer = None
+        return None
+
+    async def off(self, idle_only: bool = False) -> bool:
+        """
+        Switches the lamp off now, e.g. for a dark measurement. With `idle_only` only if it was idle for `idle_off` seconds.
+        Returns whether the lamp is off, False if the sensor did not confirm `LI0`.
+        """
+        if not idle_only:
+            self.cancel_off_timer()
+        async with self.get_lock():
+            # Checked under the lock, a scan may have used the lamp while the timer task waited
+            if self.state == LAMP_OFF:
+                return True
+            if idle_only and (self.users or time.monotonic() - self.released_at < self.idle_off):
+                return False
+            try:
+                await self.commands.transport.request(self.commands.CMDS["Light Source Power Level 0"], timeout=self.timeout)
+            except Exception as e:
+                # Still counted as on, the next off() tries again
+                print("Failed to switch the lamp off: ", e)
+                return False
+            print("LAMP OFF!")
+            self.on_time += time.monotonic() - self.on_since
+            self.state = LAMP_OFF
+        return True
+
+    def total_on_time(self) -> float:
+        """Seconds the lamp has been on since start, including the current switch-on."""
+        if self.state == LAMP_OFF:
+            return self.on_time
+        return self.on_time + time.monotonic() - self.on_since
+
+    def stats(self) -> str:
+        return f"{self.state}|{self.total_on_time():.0f}|{self.switch_ons}|{self.warm_reuses}"
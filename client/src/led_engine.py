@@ -0,0 +1,165 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+import numpy as np
+
+PRIORITY_IDLE = 0
+PRIORITY_MEASURING = 1
+PRIORITY_ERROR = 2
+
+@dataclass(eq=False)
+class Animation:
+    """
+    Precomputed frames of one LED animation.
+
+    `frames` is an (n, 3) uint8 RGB table, `values` the same frames as the (r, g, b)
+    tuples of 0... 1 gpiozero's RGBLED.value takes, built once so playing allocates
+    nothing per frame. With `hold` the last frame stays on until the animation is
+    stopped or preempted, otherwise the LED goes dark after the last frame.
+    """
+    name: str
+    frames: np.ndarray
+    interval: float
+    priority: int = PRIORITY_IDLE
+    hold: bool = False
+    values: list = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self.frames = np.ascontiguousarray(self.frames, dtype=np.uint8).reshape(-1, 3)
+        self.values = [tuple(frame) for frame in (self.frames / 255.0).tolist()]
+
+    @property
+    def duration(self) -> float:
+        return len(self.frames) * self.interval
+
+def solid(name: str, rgb: tuple, priority: int = PRIORITY_IDLE) -> Animation:
+    """A single color that stays on."""
+    return Animation(name, np.array([rgb], dtype=np.uint8), 0.0, priority, hold=True)
+
+def blink(name: str, rgb: tuple, times: int, interval: float, priority: int = PRIORITY_IDLE) -> Animation:
+    frames = np.zeros((2 * times, 3), dtype=np.uint8)
+    frames[0::2] = rgb
+    return Animation(name, frames, interval, priority)
+
+class AnimationEngine():
+    """
+    Plays one LED animation at a time in a single cancellable task.
+
+    `play()` starts an animation if its priority is at least that of the running one,
+    which is then cancelled, a lower priority animation is dropped. So an error blink is
+    never cut short by the measuring light, while a measurement takes the LED from the
+    startup animation. `stop(priority)` ends the running animation only up to that
+    priority, switching the measuring light off leaves an error blink running.
+
+    Frames are due at fixed offsets from the start of the animation, a late frame does
+    not delay the following ones. How late each frame was written is kept, see
+    `jitter_ms()`. Frames equal to the previous one are not written again.
+
+    Usage Example:
+    ```
+    engine = AnimationEngine(lambda value: setattr(led, "value", value))
+    engine.play(blink("error", (255, 0, 0), 4, 0.65, PRIORITY_ERROR))
+    await engine.wait()
+    ```
+    """
+
+    def __init__(self, output: Callable[[tuple], None], jitter_samples: int = 200) -> None:
+        self.output = output
+        self.current: Optional[Animation] = None
+        self.task: Optional[asyncio.Task] = None
+        self.last_value: Optional[tuple] = None
+        self.lateness: deque = deque(maxlen=jitter_samples)
+        self.preempted = 0
+        self.dropped = 0
+
+    def play(self, animation: Animation) -> bool:
+        """Starts `animation` unless a higher priority one is running, returns whether it was started."""
+        if self.current is not None and animation.priority < self.current.priority:
+            self.dropped += 1
+            return False
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            self.preempted += 1
+        self.current = animation
+        self.task = asyncio.get_running_loop().create_task(self.__run(animation))
+        return True
+
+    def stop(self, priority: int = PRIORITY_ERROR) -> None:
+        """Stops the running animation if its priority is at most `priority` and switches the LED off."""
+        if self.current is None or self.current.priority > priority:
+            return None
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+        self.current = None
+        self.task = None
+        self.write((0.0, 0.0, 0.0))
+        return None
+
+    async def wait(self) -> bool:
+        """Waits until the running animation ends, returns False if it was cancelled or preempted."""
+        task = self.task
+        if task is None:
+            return True
+        try:
+            await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                # The waiter itself was cancelled
+                raise
+            return False
+        return True
+
+    def write(self, value: tuple) -> None:
+        if value != self.last_value:
+            self.output(value)
+            self.last_value = value
+        return None
+
+    async def __run(self, animation: Animation) -> None:
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        values = animation.values
+        for i in range(len(values)):
+            due = start + i * animation.interval
+            delay = due - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.lateness.append(loop.time() - due)
+            self.write(values[i])
+        if animation.hold:
+            return None
+        await asyncio.sleep(max(0.0, start + len(values) * animation.interval - loop.time()))
+        self.write((0.0, 0.0, 0.0))
+        if self.current is animation:
+            self.current = None
+        return None
+
+    def jitter_ms(self) -> Optional[tuple[float, float]]:
+        """Mean and maximum lateness of the recent frames, in milliseconds."""
+        if not self.lateness:
+            return None
+        return sum(self.lateness) / len(self.lateness) * 1000, max(self.lateness) * 1000
+
+async def main():
+    """
+    Test harness without hardware, run from src with `python3 led_engine.py`.
+    Plays overlapping animations of different priority and reports the frame jitter.
+    """
+    writes = []
+    engine = AnimationEngine(writes.append)
+    fade = Animation("fade", np.linspace(0, 255, 60)[:, None] * np.array([[0, 1, 0]]), 0.05)
+    engine.play(fade)
+    await asyncio.sleep(1.0)
+    print("Measuring light preempts the fade: ", engine.play(solid("measuring", (0, 153, 0), PRIORITY_MEASURING)))
+    await asyncio.sleep(0.2)
+    print("Error blink preempts the measuring light: ", engine.play(blink("error", (178, 0, 0), 4, 0.1, PRIORITY_ERROR)))
+    engine.stop(PRIORITY_MEASURING)
+    print("Fade during the error blink: ", engine.play(fade))
+    print("Error blink completed: ", await engine.wait())
+    mean, worst = engine.jitter_ms()
+    print(f"{len(writes)} LED writes, frame lateness {mean:.2f} ms mean, {worst:.2f} ms max, {engine.preempted} preempted, {engine.dropped} dropped")
+    return
+
+if __name__ == "__main__":
+    asyncio.run(main())
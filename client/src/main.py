@@ -16,12 +16,9 @@ class Main:
         await self.event_manager.wait_for_events()
     
     async def run_uart_in_thread(self):
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        async def thread_wrapper():
-            await uart_main(self.event_manager)
-        task = loop.create_task(thread_wrapper())
-        await asyncio.to_thread(loop.run_until_complete, task)
+        # The GLib mainloop blocks its thread, BLE writes reach the event manager through
+        # EventManager.messager, which hands them back to this loop
+        await asyncio.to_thread(asyncio.run, uart_main(self.event_manager))
     
     async def main_loop(self):
         """
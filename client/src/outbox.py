@@ -0,0 +1,183 @@
+import asyncio
+import sqlite3
+import time
+from typing import Optional
+import numpy as np
+from interface import APIClient, APIError
+
+OUTBOX_PATH = "../outbox.sqlite3"
+
+class Outbox():
+    """
+    Durable queue of the raw spectra that have not reached the API yet.
+
+    Every measurement (white, dark and sample) is appended before it is uploaded and
+    removed once the API has accepted it, so nothing is lost while the device is
+    offline or the API is unreachable. Sample rows keep the ids of the white and dark
+    rows that were the current references when they were measured. Rows are uploaded
+    in id order, so the API always receives a sample after its references.
+
+    The queue is an SQLite database in WAL mode. It is bounded to `max_rows` spectra
+    (about 2 KB each), the oldest rows are dropped first when it is full. Reference rows
+    are never dropped while they are the current references or a queued sample names
+    them, the oldest samples go instead and release their references with them.
+
+    Usage Example:
+    ```
+    outbox = Outbox()
+    row_id = outbox.append(packet)
+    for row_id, packet in outbox.peek(16):
+        ...
+    outbox.remove([row_id])
+    ```
+    """
+
+    def __init__(self, path: str = OUTBOX_PATH, max_rows: int = 2000) -> None:
+        self.path = path
+        self.max_rows = max_rows
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # WAL with synchronous=NORMAL survives a crash of the process, a power cut may lose the last rows
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created REAL NOT NULL,
+                type TEXT NOT NULL,
+                time INTEGER NOT NULL,
+                device INTEGER NOT NULL,
+                data BLOB NOT NULL,
+                white_id INTEGER,
+                dark_id INTEGER
+            )""")
+        self.count = self.db.execute("SELECT count(*) FROM outbox").fetchone()[0]
+        # Latest reference rows, uploaded or not, used as the context of new samples
+        self.white_id = self.latest_id("w", "white_id")
+        self.dark_id = self.latest_id("b", "dark_id")
+
+    def latest_id(self, measure_type: str, column: str) -> Optional[int]:
+        row_id = self.db.execute("SELECT max(id) FROM outbox WHERE type = ?", (measure_type,)).fetchone()[0]
+        if row_id is None:
+            # The reference itself was uploaded already, queued samples still name it
+            row_id = self.db.execute(f"SELECT max({column}) FROM outbox").fetchone()[0]
+        return row_id
+
+    def append(self, packet: dict) -> int:
+        data = np.asarray(packet["data"], dtype="<f4").tobytes()
+        white_id, dark_id = (self.white_id, self.dark_id) if packet["type"] == "m" else (None, None)
+        cursor = self.db.execute(
+            "INSERT INTO outbox (created, type, time, device, data, white_id, dark_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (time.time(), packet["type"], packet["time"], packet["id"], data, white_id, dark_id),
+        )
+        row_id = cursor.lastrowid
+        if packet["type"] == "w":
+            self.white_id = row_id
+        elif packet["type"] == "b":
+            self.dark_id = row_id
+        self.count += 1
+        if self.count > self.max_rows:
+            # The API pairs a sample with the references uploaded before it, a reference row
+            # is kept while a queued sample names it, the samples go first
+            dropped = self.db.execute(
+                """DELETE FROM outbox WHERE id IN (
+                    SELECT id FROM outbox WHERE id NOT IN (?, ?)
+                    AND id NOT IN (SELECT white_id FROM outbox WHERE white_id IS NOT NULL)
+                    AND id NOT IN (SELECT dark_id FROM outbox WHERE dark_id IS NOT NULL)
+                    ORDER BY id LIMIT ?)""",
+                (self.white_id or -1, self.dark_id or -1, self.count - self.max_rows),
+            ).rowcount
+            self.count -= dropped
+            print(f"Outbox full, dropped {dropped} oldest measurements")
+        return row_id
+
+    def peek(self, limit: int) -> list[tuple[int, dict]]:
+        """Returns up to `limit` of the oldest rows as (row id, packet) without removing them."""
+        rows = self.db.execute(
+            "SELECT id, type, time, device, data FROM outbox ORDER BY id LIMIT ?", (limit,)
+        ).fetchall()
+        return [
+            (row_id, {
+                "data": np.frombuffer(data, dtype="<f4"),
+                "time": timestamp,
+                "id": device,
+                "type": measure_type,
+            })
+            for row_id, measure_type, timestamp, device, data in rows
+        ]
+
+    def remove(self, row_ids: list[int]) -> None:
+        if not row_ids:
+            return None
+        removed = self.db.executemany("DELETE FROM outbox WHERE id = ?", [(row_id,) for row_id in row_ids]).rowcount
+        self.count -= removed
+        return None
+
+    def close(self) -> None:
+        self.db.close()
+        return None
+
+class OutboxUploader():
+    """
+    Background task that drains the outbox into the API.
+
+    Waits until the API client is registered and rows are pending, then uploads the
+    oldest `batch_size` rows one after another over the client's keep-alive session
+    and removes the accepted ones in one statement. A failed upload stops the batch and
+    the next attempt waits with exponential backoff, the client re-registers in the
+    meantime. Rows the API rejects with a 4xx are dropped, retrying them cannot succeed.
+    """
+
+    def __init__(self, outbox: Outbox, api_client: APIClient, batch_size: int = 16,
+                 retry_delay: float = 2.0, max_retry_delay: float = 300.0) -> None:
+        self.outbox = outbox
+        self.api_client = api_client
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.pending: Optional[asyncio.Event] = None
+        self.uploaded = 0
+        self.dropped = 0
+
+    def kick(self) -> None:
+        """Wakes the uploader after rows were appended."""
+        if self.pending is not None:
+            self.pending.set()
+        return None
+
+    async def upload_batch(self) -> bool:
+        """Uploads the oldest rows, returns False if an upload failed and the rest has to wait."""
+        done = []
+        success = True
+        for row_id, packet in self.outbox.peek(self.batch_size):
+            try:
+                await self.api_client.upload(packet)
+                self.uploaded += 1
+            except APIError as e:
+                if not 400 <= e.status < 500:
+                    success = False
+                    break
+                print(f"API rejected outbox row {row_id}, dropping it: {e}")
+                self.dropped += 1
+            except Exception as e:
+                print(f"Outbox upload failed: {e}")
+                success = False
+                break
+            done.append(row_id)
+        self.outbox.remove(done)
+        return success
+
+    async def run(self) -> None:
+        self.pending = asyncio.Event()
+        delay = self.retry_delay
+        while True:
+            await self.api_client.online.wait()
+            self.pending.clear()
+            if self.outbox.count == 0:
+                await self.pending.wait()
+                continue
+            if await self.upload_batch():
+                delay = self.retry_delay
+                continue
+            print(f"Retrying outbox upload in {delay:.0f} s, {self.outbox.count} measurements pending")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_retry_delay)
@@ -0,0 +1,85 @@
+from typing import Optional
+import numpy as np
+
+SPECTRUM_POINTS = 512
+# Spans and ranges below this are treated as zero to avoid dividing by noise
+EPSILON = 1e-9
+
+class ReflectancePipeline():
+    """
+    Turns raw sensor counts into min-max scaled reflectance using the white and dark references.
+
+    The references are kept as float32 arrays and the reciprocal 1 / (white - dark) is
+    computed once when a reference is captured, so each measurement only costs a few
+    in-place array operations on a preallocated output buffer.
+
+    Channels where white equals dark have no usable span and are set to 0.
+
+    `generation` counts the captured references, results derived from an older
+    calibration can be told apart by it.
+
+    Usage Example:
+    ```
+    pipeline = ReflectancePipeline()
+    pipeline.set_white(white_counts)
+    pipeline.set_dark(dark_counts)
+    scaled = pipeline.process(measurement_counts)
+    ```
+    """
+
+    def __init__(self, points: int = SPECTRUM_POINTS) -> None:
+        self.points = points
+        self.white: Optional[np.ndarray] = None
+        self.dark: Optional[np.ndarray] = None
+        self._inv_span = np.zeros(points, dtype=np.float32)
+        self._span = np.empty(points, dtype=np.float32)
+        self._out = np.empty(points, dtype=np.float32)
+        self.generation = 0
+        pass
+
+    @property
+    def is_calibrated(self) -> bool:
+        return self.white is not None and self.dark is not None
+
+    def set_white(self, values) -> None:
+        self.white = np.array(values, dtype=np.float32)
+        self._update_span()
+        return None
+
+    def set_dark(self, values) -> None:
+        self.dark = np.array(values, dtype=np.float32)
+        self._update_span()
+        return None
+
+    def _update_span(self) -> None:
+        self.generation += 1
+        if not self.is_calibrated:
+            return None
+        np.subtract(self.white, self.dark, out=self._span)
+        self._inv_span.fill(0)
+        np.divide(1.0, self._span, out=self._inv_span, where=np.abs(self._span) > EPSILON)
+        return None
+
+    def process(self, measurement) -> np.ndarray:
+        """
+        Returns the min-max scaled reflectance of `measurement`.
+
+        The result is written into a buffer owned by the pipeline and is overwritten
+        by the next call, copy it if it has to outlive the current measurement.
+
+        Raises:
+            ValueError: If either reference has not been captured yet.
+        """
+        if not self.is_calibrated:
+            raise ValueError("White and dark references are required before processing")
+        out = self._out
+        np.subtract(measurement, self.dark, out=out)
+        np.multiply(out, self._inv_span, out=out)
+        low = out.min()
+        value_range = out.max() - low
+        if value_range > EPSILON:
+            np.subtract(out, low, out=out)
+            np.multiply(out, 1.0 / value_range, out=out)
+        else:
+            out.fill(0)
+        return out
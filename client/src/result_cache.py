@@ -0,0 +1,103 @@
+import time
+from collections import OrderedDict
+from typing import Optional
+import numpy as np
+
+class ResultCache():
+    """
+    LRU cache of inference results for spectra that were already classified.
+
+    Rescanning the same swatch gives a slightly different spectrum every time, so entries
+    are keyed on a fingerprint of the preprocessed (reflectance scaled) spectrum: it is
+    averaged over `bins` bands and each band is quantized to `levels` steps. By default
+    only an exact fingerprint hits. One step is already about the difference between
+    neighbouring blend ratios, so the near match is opt-in: with `tolerance` above 0 a
+    lookup also accepts an entry whose bands are all within that many steps. Only set it
+    after checking real rescans against neighbouring blends. The key also
+    holds the model version and the calibration generation, so a new model or new
+    references never return an old result.
+
+    Entries expire `ttl` seconds after they were stored and the least recently used
+    entry is evicted once `max_entries` are held.
+
+    Usage Example:
+    ```
+    cache = ResultCache()
+    key = cache.key(cache.fingerprint(scaled_reflectance), model_version, calibration_generation)
+    result = cache.get(key)
+    if result is None:
+        result = await classify(scaled_reflectance)
+        cache.put(key, result)
+    ```
+    """
+
+    def __init__(self, max_entries: int = 64, ttl: float = 600.0, bins: int = 32, levels: int = 50, tolerance: int = 0) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.bins = bins
+        self.levels = levels
+        self.tolerance = tolerance
+        self.entries: OrderedDict[tuple, tuple[float, str]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def fingerprint(self, spectrum: np.ndarray) -> bytes:
+        values = np.asarray(spectrum, dtype=np.float32)
+        usable = values.size - values.size % self.bins
+        bands = values[:usable].reshape(self.bins, -1).mean(axis=1)
+        return np.clip(np.rint(bands * self.levels), 0, self.levels).astype(np.uint8).tobytes()
+
+    def key(self, fingerprint: bytes, model_version: Optional[str], generation: int = 0) -> Optional[tuple]:
+        """Returns the cache key for a fingerprint, or None if the model version is unknown and results can not be cached."""
+        if model_version is None:
+            return None
+        return (fingerprint, model_version, generation)
+
+    def get(self, key: Optional[tuple]) -> Optional[str]:
+        if key is None:
+            return None
+        self.expire()
+        if key not in self.entries:
+            key = self.nearest(key) if self.tolerance > 0 else None
+            if key is None:
+                self.misses += 1
+                return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return self.entries[key][1]
+
+    def nearest(self, key: tuple) -> Optional[tuple]:
+        """Returns the held key of the same model and calibration whose bands are all within tolerance of `key`."""
+        fingerprint, model_version, generation = key
+        bands = np.frombuffer(fingerprint, dtype=np.uint8).astype(np.int16)
+        for held in reversed(self.entries):
+            if held[1] != model_version or held[2] != generation or len(held[0]) != len(fingerprint):
+                continue
+            if np.abs(np.frombuffer(held[0], dtype=np.uint8) - bands).max() <= self.tolerance:
+                return held
+        return None
+
+    def expire(self) -> None:
+        # Entries are in insertion / use order, but a recently used entry may still be old, check them all
+        now = time.monotonic()
+        for key in [key for key, (stored, _) in self.entries.items() if now - stored > self.ttl]:
+            del self.entries[key]
+        return None
+
+    def put(self, key: Optional[tuple], result: str) -> None:
+        if key is None or not result:
+            return None
+        self.entries[key] = (time.monotonic(), result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return None
+
+    def clear(self) -> None:
+        self.entries.clear()
+        return None
+
+    def stats(self) -> str:
+        return f"{self.hits} hits, {self.misses} misses, {self.evictions} evicted, {len(self.entries)} held"
@@ -0,0 +1,165 @@
+"""
+Savitzky-Golay smoothing without scipy.
+
+Simplified from scipy.signal.savgol_filter for 1-D spectra with the default
+mode="interp": the centre of the signal is filtered with one convolution and the
+first and last window_length // 2 points are taken from a polynomial fitted to the
+first and last window. Both the convolution kernel and the edge fits are linear in
+the input, so they are computed once per (window_length, polyorder, deriv, delta)
+and cached.
+"""
+from functools import lru_cache
+from math import factorial
+from typing import NamedTuple, Optional
+import numpy as np
+
+class SavgolKernel(NamedTuple):
+    # Correlation coefficients for the points that have a full window around them
+    coeffs: np.ndarray
+    # Matrices mapping the first / last window onto the window_length // 2 edge outputs
+    left: np.ndarray
+    right: np.ndarray
+
+def _derivative_basis(positions: np.ndarray, polyorder: int, deriv: int) -> np.ndarray:
+    """Rows of d^deriv/dt^deriv [1, t, t^2, ...] evaluated at `positions`."""
+    basis = np.zeros((len(positions), polyorder + 1))
+    for k in range(deriv, polyorder + 1):
+        basis[:, k] = factorial(k) / factorial(k - deriv) * positions ** (k - deriv)
+    return basis
+
+@lru_cache(maxsize=16)
+def savgol_kernel(window_length: int, polyorder: int, deriv: int = 0, delta: float = 1.0) -> SavgolKernel:
+    if polyorder >= window_length:
+        raise ValueError("polyorder must be less than window_length.")
+    halflen, rem = divmod(window_length, 2)
+    # Even windows are evaluated between the two middle points, as scipy does
+    pos = halflen if rem else halflen - 0.5
+    scale = 1.0 / delta ** deriv
+
+    if deriv > polyorder:
+        coeffs = np.zeros(window_length)
+    else:
+        x = np.arange(-pos, window_length - pos, dtype=float)
+        A = x ** np.arange(polyorder + 1).reshape(-1, 1)
+        y = np.zeros(polyorder + 1)
+        y[deriv] = factorial(deriv) * scale
+        coeffs, _, _, _ = np.linalg.lstsq(A, y, rcond=None)
+
+    t = np.arange(window_length, dtype=float)
+    fit = np.linalg.pinv(_derivative_basis(t, polyorder, 0))
+    left = _derivative_basis(t[:halflen], polyorder, deriv) @ fit * scale
+    right = _derivative_basis(t[window_length - halflen:], polyorder, deriv) @ fit * scale
+
+    for array in (coeffs, left, right):
+        array.flags.writeable = False
+    return SavgolKernel(coeffs, left, right)
+
+def savgol_filter(x, window_length: int, polyorder: int, deriv: int = 0, delta: float = 1.0,
+                  out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Applies a Savitzky-Golay filter to the 1-D array `x`.
+
+    Matches scipy.signal.savgol_filter(x, window_length, polyorder, deriv, delta) with mode="interp".
+
+    Args:
+        x: 1-D input signal.
+        window_length (int): Length of the filter window, odd or even.
+        polyorder (int): Order of the fitted polynomial, less than window_length.
+        deriv (int): Order of the derivative to compute, 0 smooths without differentiating.
+        delta (float): Sample spacing, only used when deriv > 0.
+        out (np.ndarray): Optional preallocated output with the same shape as `x`.
+
+    Returns:
+        np.ndarray: The filtered signal, float32 for float32 input and float64 otherwise.
+    """
+    x = np.asarray(x)
+    if x.dtype != np.float64 and x.dtype != np.float32:
+        x = x.astype(np.float64)
+    if x.ndim != 1:
+        raise ValueError("x must be a 1-D array.")
+    n = x.shape[0]
+    if window_length > n:
+        raise ValueError("window_length must be less than or equal to the size of x.")
+    kernel = savgol_kernel(window_length, polyorder, deriv, float(delta))
+    if out is None:
+        out = np.empty_like(x)
+
+    halflen = window_length // 2
+    start = (window_length - 1) // 2
+    out[start:start + n - window_length + 1] = np.correlate(x, kernel.coeffs, mode="valid")
+    out[:halflen] = kernel.left @ x[:window_length]
+    out[n - halflen:] = kernel.right @ x[n - window_length:]
+    return out
+
+class SavgolFilter():
+    """
+    Smoothing stage for spectra with fixed filter parameters.
+
+    The kernel is built on construction and the output buffer is reused between
+    calls, so each spectrum costs one convolution and two small matrix products.
+    Defaults follow the model notebook (window_size = 30, poly_order = 3).
+
+    Usage Example:
+    ```
+    smoothing = SavgolFilter(30, 3)
+    smoothed = smoothing.apply(spectrum)
+    ```
+    """
+
+    def __init__(self, window_length: int = 30, polyorder: int = 3, deriv: int = 0, delta: float = 1.0) -> None:
+        self.window_length = window_length
+        self.polyorder = polyorder
+        self.deriv = deriv
+        self.delta = float(delta)
+        savgol_kernel(window_length, polyorder, deriv, self.delta)
+        self._out: Optional[np.ndarray] = None
+        pass
+
+    def apply(self, spectrum: np.ndarray) -> np.ndarray:
+        """
+        Returns the filtered spectrum in a buffer owned by the stage,
+        it is overwritten by the next call.
+        """
+        spectrum = np.asarray(spectrum, dtype=np.float32)
+        if self._out is None or self._out.shape != spectrum.shape:
+            self._out = np.empty_like(spectrum)
+        return savgol_filter(spectrum, self.window_length, self.polyorder, self.deriv, self.delta, out=self._out)
+
+# (window_length, polyorder, deriv, delta) checked against scipy by main(), 30/3 is the notebook setting
+CHECK_CASES = (
+    (30, 3, 0, 1.0),
+    (31, 3, 0, 1.0),
+    (11, 2, 0, 1.0),
+    (10, 4, 0, 1.0),
+    (11, 2, 1, 1.0),
+    (30, 3, 2, 1.0),
+    (31, 4, 3, 0.5),
+    (7, 2, 3, 1.0),
+)
+# float64 input should agree to rounding, float32 input is compared against scipy's float64 result
+FLOAT64_TOLERANCE = 1e-9
+FLOAT32_TOLERANCE = 1e-5
+
+def main():
+    """
+    Checks savgol_filter against scipy.signal.savgol_filter, run from src with `python3 savgol.py`.
+    Exits with an AssertionError on the first mismatch beyond the tolerance, scipy is required.
+    """
+    from scipy.signal import savgol_filter as scipy_savgol_filter
+    rng = np.random.default_rng(0)
+    # A smooth spectrum with noise, plus a steep edge so the end fits are exercised
+    x = np.sin(np.linspace(0, 8, 512)) + 0.05 * rng.standard_normal(512) + np.linspace(0, 3, 512) ** 2
+    for window_length, polyorder, deriv, delta in CHECK_CASES:
+        expected = scipy_savgol_filter(x, window_length, polyorder, deriv, delta)
+        scale = max(1.0, np.abs(expected).max())
+        diff64 = np.abs(savgol_filter(x, window_length, polyorder, deriv, delta) - expected).max() / scale
+        stage = SavgolFilter(window_length, polyorder, deriv, delta)
+        diff32 = np.abs(stage.apply(x.astype(np.float32)) - expected).max() / scale
+        print(f"savgol {window_length}/{polyorder}/{deriv} delta {delta}: max diff {diff64:.1e} (float64), {diff32:.1e} (float32)")
+        assert diff64 <= FLOAT64_TOLERANCE, f"float64 result differs from scipy by {diff64:.1e}"
+        assert diff32 <= FLOAT32_TOLERANCE, f"float32 result differs from scipy by {diff32:.1e}"
+    print(f"All {len(CHECK_CASES)} settings match scipy")
+    return
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,44 @@
 import asyncio
+import json
+import os
 import serial
-from copy import deepcopy
-import struct
+import numpy as np
+from typing import Optional
+from env import ENV
+from burst import BurstAccumulator
+from serial_transport import SerialTransport, SerialFrameError, SerialTimeout
+from command_engine import CommandEngine
+from lamp import LampController
+
+SPECTRUM_POINTS = 512
+# Number of W{i},{wl} commands written per chunk while programming the wavelength grid
+WL_CHUNK_SIZE = 32
+WL_CACHE_PATH = "../wavelength_cache.json"
+# Per-command reply timeouts in seconds, XM only replies once the scan has finished
+REPLY_TIMEOUT = 2.0
+SCAN_TIMEOUT = 10.0
+SPECTRUM_TIMEOUT = 5.0
 
 class SerialDevice():
 
-    def __init__(self, event_manager) -> None:
+    def __init__(self, event_manager, port: str = "/dev/ttyACM0", wl_cache_path: str = WL_CACHE_PATH) -> None:
         self.event_manager = event_manager
+        self.port = port
+        self.wl_cache_path = wl_cache_path
         self.received_data: asyncio.Queue
         self.send_measurement: asyncio.Event
         self.data_queue = []
         self.measurement_points: list[float]
         self.sensor_temp: str = "0"
+        # Last St reading, None until the sensor answered
+        self.sensor_temperature: Optional[float] = None
+        self.sensor_currents: tuple[float, ...] = ()
+        # Per wavelength variance of the last burst, None after a single scan
+        self.last_variance: Optional[np.ndarray] = None
         self.ser: serial.Serial
-        self.serial_init()
+        self.transport: SerialTransport
+        self.commands: CommandEngine
+        self.lamp: LampController
         self.CMDS = {
             "Sensor Type": "h0\r",
             "Hardware Version": "h1\r",
@@ -52,6 +77,7 @@ class SerialDevice():
             "Get Measurement Float Values": "Xm0,{datalength}\r",
             "Set Measurement on Wavelength": "W0,{wavelength}\r",
         }
+        self.serial_init()
         pass
         
     async def shared_objects(self, queue: asyncio.Queue, event: asyncio.Event) -> None:
@@ -74,29 +100,46 @@ class SerialDevice():
                 pass
         return None
 
-    def measure_get(self) -> None:
-        while self.ser.in_waiting != 0:
-            self.ser.read(1)
-            pass
-        data_vec = []
-        ba = bytearray()
-        total_bytes_to_read = 2048
-        sensor_data = self.ser.read(1)
-        while len(ba) < total_bytes_to_read:
-            ba.extend(sensor_data)
-            del sensor_data
-            sensor_data = self.ser.read(1)
-        for i in range(0, len(ba)-3, 4):
-            float_value = struct.unpack('<f', ba[i:i+4])[0]
-            data_vec.append(float_value)
-        if len(data_vec) == 512:
-            self.received_data.put_nowait(deepcopy(data_vec))
-            data_vec.clear()
+    async def measure_get(self) -> None:
+        """
+        Reads the `Xm0,512` payload into a float32 array and hands it to the queue without copying.
+
+        Raises:
+            SerialFrameError: If the sensor stops sending before the full payload has arrived.
+        """
+        self.received_data.put_nowait(await self.read_spectrum())
         return None
 
+    async def read_spectrum(self) -> np.ndarray:
+        cmd = self.CMDS["Get Measurement Float Values"].format(datalength=SPECTRUM_POINTS)
+        return await self.transport.read_floats(cmd, SPECTRUM_POINTS, timeout=SPECTRUM_TIMEOUT)
+
+    async def measure_burst(self, scans: int) -> bool:
+        """
+        Takes `scans` scans back to back and queues their average, the lamp stays as it is.
+
+        Scans that fail to read or are rejected as outliers are skipped, the burst is
+        queued if at least one scan was accepted. The per wavelength variance of the
+        burst is kept in `last_variance`.
+        """
+        burst = BurstAccumulator(SPECTRUM_POINTS, scans, ENV.BURST_MODE)
+        for i in range(scans):
+            try:
+                await self.transport.request(self.CMDS["Measurement Ready"], timeout=SCAN_TIMEOUT)
+                if not burst.add(await self.read_spectrum()):
+                    print(f"Burst scan {i + 1} rejected as an outlier")
+            except (SerialFrameError, SerialTimeout) as e:
+                print(f"Burst scan {i + 1} dropped: ", e)
+        result = burst.result()
+        if result is None:
+            return False
+        print(f"BURST: {result.accepted}/{scans} scans averaged, {result.rejected} rejected")
+        self.last_variance = result.variance
+        self.received_data.put_nowait(result.spectrum)
+        return True
+
     def serial_init(self) -> None:
-        self.ser = serial.Serial()
-        self.ser.port = "/dev/ttyACM0"
+        self.ser = serial.serial_for_url(self.port, do_not_open=True)
         self.ser.baudrate = 115200
         self.ser.bytesize = serial.EIGHTBITS
         self.ser.parity = serial.PARITY_NONE
@@ -109,26 +152,104 @@ class SerialDevice():
         self.ser.rts = True
         try:
             self.ser.open()
-            self.sensor_wl_read(self.ser, 512, 1550.0, 1950.0)
         except:
             print("Failed to open serial port.")
+            return None
+        self.transport = SerialTransport(self.ser)
+        self.commands = CommandEngine(self.transport, self.CMDS)
+        self.lamp = LampController(self.commands, idle_off=ENV.LAMP_IDLE_OFF)
+        try:
+            self.sensor_wl_setup(SPECTRUM_POINTS, 1550.0, 1950.0)
+        except Exception as e:
+            print("Failed to program wavelengths: ", e)
         return None
 
-    def sensor_wl_read(self, ser: serial.Serial, measurement_count: int, min_wl: float, max_wl: float) -> None:
+    def sensor_wl_setup(self, measurement_count: int, min_wl: float, max_wl: float) -> None:
+        """
+        Programs the wavelength grid, unless the connected sensor already holds the same grid.
+
+        The last programmed grid is stored together with the sensor serial number (`h2`),
+        so a reboot with the same sensor only costs a single query.
+        """
+        serial_number = self.query(self.CMDS["Serial Number"])
+        config = {
+            "count": measurement_count,
+            "min_wl": min_wl,
+            "max_wl": max_wl,
+            "serial": serial_number,
+        }
+        if serial_number and self.load_wl_config() == config:
+            print("Wavelength grid unchanged, skipping programming")
+            self.measurement_points = self.wavelength_grid(measurement_count, min_wl, max_wl)
+            return None
+        self.sensor_wl_read(self.ser, measurement_count, min_wl, max_wl)
+        if serial_number:
+            self.save_wl_config(config)
+        return None
+
+    def load_wl_config(self) -> dict:
+        try:
+            with open(self.wl_cache_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_wl_config(self, config: dict) -> None:
+        # Written through a temporary file so a power cut can not leave half a cache behind
+        tmp_path = self.wl_cache_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(config, f)
+            os.replace(tmp_path, self.wl_cache_path)
+        except OSError as e:
+            print("Failed to save wavelength configuration: ", e)
+        return None
+
+    def query(self, cmd: str) -> str:
+        """Sends a single command and returns its reply without the terminator."""
+        self.ser.write(cmd.encode())
+        reply = self.ser.read_until(b'\r')
+        if not reply.endswith(b'\r'):
+            return ""
+        return reply.decode(errors='ignore').strip()
+
+    def write_pipelined(self, cmds: list[str], chunk_size: int = WL_CHUNK_SIZE) -> None:
+        """
+        Writes commands in chunks of `chunk_size` and collects one acknowledgement per command.
+
+        Raises:
+            SerialFrameError: If the sensor acknowledges fewer commands than were sent.
+        """
+        for start in range(0, len(cmds), chunk_size):
+            chunk = cmds[start:start + chunk_size]
+            self.ser.write("".join(chunk).encode())
+            self.read_acks(len(chunk))
+        return None
+
+    def read_acks(self, count: int) -> None:
+        received = 0
+        while received < count:
+            data = self.ser.read(max(1, self.ser.in_waiting))
+            if not data:
+                raise SerialFrameError(f"Missing acknowledgements: {received}/{count}")
+            received += data.count(b'\r')
+        return None
+
+    @staticmethod
+    def wavelength_grid(measurement_count: int, min_wl: float, max_wl: float) -> list[float]:
         measurement_points = []
-        cmd = ""
         current_wl = min_wl
         gap = (max_wl - min_wl) / (measurement_count - 1)
         for i in range(measurement_count - 1):
-            cmd = "W{0},{1:.1f}\r".format(i, current_wl)
-            self.write_command(cmd)
             measurement_points.append(current_wl)
             current_wl += gap
-            self.read_response()
-        cmd = "W{0},{1:.1f}\r".format(measurement_count - 1, max_wl)
-        self.write_command(cmd)
-        self.read_response()
         measurement_points.append(max_wl)
+        return measurement_points
+
+    def sensor_wl_read(self, ser: serial.Serial, measurement_count: int, min_wl: float, max_wl: float) -> None:
+        measurement_points = self.wavelength_grid(measurement_count, min_wl, max_wl)
+        cmds = ["W{0},{1:.1f}\r".format(i, wl) for i, wl in enumerate(measurement_points)]
+        self.write_pipelined(cmds)
         self.measurement_points = measurement_points
         return None
 
@@ -138,71 +259,64 @@ class SerialDevice():
         while self.ser.in_waiting != 0:
             self.ser.read(1)
     
-    async def measure(self, type: str) -> bool:
+    async def measure(self, type: str, scans: int = 1) -> bool:
+        measured = False
+        lamp_acquired = False
         try:
             print("STARTING MEAS")
             if not type == "b":
-                cmd = "LI100\n" #turn on lamp
-                self.write_command(cmd)
-                self.read_response()
-                self.serial_flush()
-                print("LAMP ON!")
-            cmd = "XM\n"
-            self.write_command(cmd)
-            self.read_response()
-            self.serial_flush()
-            print("MEAS READY!")
-            cmd = "Xm0,512\n"
-            self.write_command(cmd)
-            print("READ READY!")
-            self.measure_get()
-            self.serial_flush()
-            print("READ DONE")
-            self.send_measurement.set()
-            if not type == "b":
-                cmd = "LI0\n"
-                self.write_command(cmd)
-                self.read_response()
-                self.serial_flush()
-                print("LAMP OFF!")
+                await self.lamp.acquire()
+                lamp_acquired = True
+            else:
+                # A lamp kept warm by the previous scan would light the dark reference
+                if not await self.lamp.off():
+                    print("Dark measurement aborted, the lamp is not confirmed off")
+                    return measured
+            if scans > 1:
+                # One lamp cycle for the whole burst
+                measured = await self.measure_burst(scans)
+            else:
+                await self.transport.request(self.CMDS["Measurement Ready"], timeout=SCAN_TIMEOUT)
+                print("MEAS READY!")
+                try:
+                    await self.measure_get()
+                    measured = True
+                    self.last_variance = None
+                    print("READ DONE")
+                except (SerialFrameError, SerialTimeout) as e:
+                    print("Measurement dropped: ", e)
+            if measured:
+                self.send_measurement.set()
         except Exception as e:
             print("SerialDevice class had an exception at method measure(): \n",e)
             pass
         finally:
-            # Update sensor temperature
-            self.get_sensor_temp()
+            if lamp_acquired:
+                # Stays warm for the next scan, goes off after LAMP_IDLE_OFF seconds without one
+                self.lamp.release()
+            # Update sensor temperature and currents
+            await self.read_sensor_status()
             pass
-        return True
+        return measured
     
-    def get_sensor_temp(self):
+    async def read_sensor_status(self) -> None:
+        """Reads temperature and lamp currents in one batched exchange."""
         if (self.ser.is_open):
-            print("RETURNING SER TEMP")
-            ba = bytearray()
-            result = ""
             try:
-                cmd = self.CMDS["Temperature Value"]
-                self.write_command(cmd)
-                while True:
-                    byte = self.ser.read(1)
-                    ba.extend(byte)
-                    if byte == b'\r':
-                        break
-                    elif byte != b'\n':
-                        pass
-                result = ba.decode("utf-8")
-                print("RESULT: ", result)
-                temperature_str = result.split(":")[1].strip()
-                try:
-                    # Try parsing as float first
-                    temperature_value = int(float(temperature_str))
-                except ValueError:
-                    # If parsing as float fails, remove scientific notation (e.g., "3.20e+01") and convert to int
-                    temperature_value = int(temperature_str.split("e")[0])
-                print("PARSED TEMP: ", str(temperature_value))
-                self.sensor_temp = str(temperature_value)
-                self.serial_flush()
+                status = await self.commands.query(
+                    "Temperature Value",
+                    "Current1 (mA), Current2 (mA)",
+                    timeout=REPLY_TIMEOUT,
+                )
+                print("SENSOR STATUS: ", status)
+                temperature = status["Temperature Value"]
+                self.sensor_temp = "err" if temperature is None else str(int(temperature))
+                self.sensor_temperature = temperature
+                self.sensor_currents = status["Current1 (mA), Current2 (mA)"] or ()
             except Exception as e:
-                print("SerialDevice class had an exception at method measure(): \n",e)
+                print("SerialDevice class had an exception at method read_sensor_status(): \n",e)
                 self.sensor_temp = "err"
+                # Not the previous reading, a reference scanned now must not be filed under it
+                self.sensor_temperature = None
                 pass
-        return
\ No newline at end of file
+        return None
@@ -0,0 +1,106 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import serial
+
+class SerialFrameError(Exception):
+    """Raised when the sensor returns fewer payload bytes than the command requested."""
+    pass
+
+class SerialTimeout(Exception):
+    """Raised when the sensor does not terminate a reply within the command timeout."""
+    pass
+
+class SerialTransport():
+    """
+    Asynchronous request/response transport for the Nirone command protocol.
+
+    All blocking pyserial calls run on one dedicated I/O thread, so requests are
+    executed in the order they were awaited and the event loop keeps running
+    while the sensor is busy. Each request carries its own timeout, which is
+    applied both to the blocking read on the I/O thread and to the awaiting coroutine.
+
+    Usage Example:
+    ```
+    transport = SerialTransport(ser)
+    reply = await transport.request("St\\r", timeout=2)
+    ```
+    """
+
+    def __init__(self, ser: serial.Serial) -> None:
+        self.ser = ser
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="nirone-io")
+        pass
+
+    async def _submit(self, timeout: float, fn, *args):
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, fn, *args)
+        try:
+            # The I/O thread gives up on its own after `timeout`, the margin covers thread handoff
+            return await asyncio.wait_for(future, timeout + 0.5)
+        except asyncio.TimeoutError:
+            raise SerialTimeout(f"No reply within {timeout}s")
+
+    async def request(self, cmd: str, timeout: float = 2.0) -> str:
+        """Sends `cmd` and returns its `\\r` terminated reply, decoded and stripped."""
+        return await self._submit(timeout, self._exchange, cmd, timeout)
+
+    async def batch(self, cmds: list[str], timeout: float = 2.0) -> list[str]:
+        """
+        Sends all `cmds` in one write and returns their replies in request order.
+
+        The sensor answers strictly in the order it receives commands, so the n-th
+        `\r` terminated reply belongs to the n-th command. `timeout` applies per reply.
+        """
+        return await self._submit(timeout * len(cmds), self._exchange_batch, cmds, timeout)
+
+    async def read_floats(self, cmd: str, count: int, timeout: float = 5.0) -> np.ndarray:
+        """Sends `cmd` and reads a binary payload of `count` little-endian float32 values."""
+        return await self._submit(timeout, self._exchange_floats, cmd, count, timeout)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        return None
+
+    def _set_timeout(self, timeout: float) -> None:
+        # Reconfiguring the port is a syscall, only do it when the value changes
+        if self.ser.timeout != timeout:
+            self.ser.timeout = timeout
+        return None
+
+    def _exchange(self, cmd: str, timeout: float) -> str:
+        self._set_timeout(timeout)
+        # Drop anything left over from a previous reply before starting a new exchange
+        self.ser.reset_input_buffer()
+        self.ser.write(cmd.encode())
+        reply = self.ser.read_until(b'\r')
+        if not reply.endswith(b'\r'):
+            raise SerialTimeout(f"No reply to {cmd.strip()!r} within {timeout}s")
+        return reply.decode(errors='ignore').strip()
+
+    def _exchange_batch(self, cmds: list[str], timeout: float) -> list[str]:
+        self._set_timeout(timeout)
+        self.ser.reset_input_buffer()
+        self.ser.write("".join(cmds).encode())
+        replies = []
+        for cmd in cmds:
+            reply = self.ser.read_until(b'\r')
+            if not reply.endswith(b'\r'):
+                raise SerialTimeout(f"No reply to {cmd.strip()!r} within {timeout}s ({len(replies)}/{len(cmds)} replies)")
+            replies.append(reply.decode(errors='ignore').strip())
+        return replies
+
+    def _exchange_floats(self, cmd: str, count: int, timeout: float) -> np.ndarray:
+        self._set_timeout(timeout)
+        self.ser.reset_input_buffer()
+        self.ser.write(cmd.encode())
+        # Filled in place through a byte view, the array is handed on without copying.
+        # pyserial keeps reading until the view is full or the timeout expires.
+        values = np.empty(count, dtype='<f4')
+        view = memoryview(values).cast('B')
+        total = len(view)
+        received = self.ser.readinto(view) or 0
+        view.release()
+        if received != total:
+            raise SerialFrameError(f"Short read on {cmd.strip()!r}: {received}/{total} bytes")
+        return values
@@ -0,0 +1,71 @@
+import json
+import struct
+import zlib
+import numpy as np
+
+# Media type of the binary spectrum upload, JSON stays the default
+JSON_MEDIA_TYPE = "application/json"
+SPECTRUM_MEDIA_TYPE = "application/vnd.nir-spectrum"
+
+# magic, version, dtype code, measurement type, device id, unix time, point count
+HEADER = struct.Struct("<4sBBcxIIH")
+MAGIC = b"NIRS"
+VERSION = 1
+
+# Little-endian sample types, keyed by the dtype code in the header
+DTYPES = {
+    1: np.dtype("<f4"),
+    2: np.dtype("<f2"),
+}
+DTYPE_CODES = {"float32": 1, "float16": 2}
+
+class SpectrumFormatError(Exception):
+    pass
+
+def encode_json(packet: dict) -> bytes:
+    data = packet["data"]
+    if isinstance(data, np.ndarray):
+        packet = dict(packet, data=data.tolist())
+    return json.dumps(packet).encode()
+
+def encode_spectrum(packet: dict, dtype: str = "float32") -> bytes:
+    """
+    Packs a measurement packet (data, id, time, type) into the binary upload format:
+    an 18 byte header followed by the samples as little-endian float32 or float16.
+
+    float16 halves the payload again, at up to ~5e-4 relative error and saturating at
+    65504, so it is only used when asked for.
+    """
+    code = DTYPE_CODES[dtype]
+    samples = np.asarray(packet["data"], dtype=DTYPES[code])
+    header = HEADER.pack(MAGIC, VERSION, code, packet["type"].encode(), packet["id"], packet["time"], samples.size)
+    return header + samples.tobytes()
+
+def decode_spectrum(payload: bytes) -> dict:
+    if len(payload) < HEADER.size:
+        raise SpectrumFormatError("Payload shorter than header")
+    magic, version, code, measure_type, device_id, timestamp, count = HEADER.unpack_from(payload)
+    if magic != MAGIC or version != VERSION:
+        raise SpectrumFormatError("Not a spectrum payload")
+    if code not in DTYPES:
+        raise SpectrumFormatError(f"Unknown sample type {code}")
+    dtype = DTYPES[code]
+    if len(payload) != HEADER.size + count * dtype.itemsize:
+        raise SpectrumFormatError("Payload length does not match point count")
+    return {
+        "data": np.frombuffer(payload, dtype=dtype, count=count, offset=HEADER.size).astype(np.float32),
+        "time": timestamp,
+        "id": device_id,
+        "type": measure_type.decode(),
+    }
+
+def deflate(payload: bytes, level: int = 6) -> bytes:
+    # HTTP "deflate" content coding is the zlib format, header and checksum included
+    return zlib.compress(payload, level)
+
+def inflate(payload: bytes) -> bytes:
+    return zlib.decompress(payload)
+
+def parse_media_types(header: str) -> set:
+    """Media types or codings listed in an Accept-Post / Accept-Encoding header value, parameters dropped."""
+    return {item.split(";")[0].strip().lower() for item in header.split(",") if item.strip()}